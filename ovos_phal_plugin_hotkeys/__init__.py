@@ -10,69 +10,337 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import json
+from itertools import count
+from threading import Event
+
 from ovos_bus_client.message import Message
 from ovos_plugin_manager.phal import PHALPlugin
 from ovos_utils.log import LOG
 
 import ovos_phal_plugin_hotkeys.keyboard as keyboard
+from ovos_phal_plugin_hotkeys.emitter import EmitThrottle, EmitWorker, OfflineBuffer
+from ovos_phal_plugin_hotkeys.gestures import HoldDetector, RepeatLimiter, TapCounter
 
 
 class HotKeysPlugin(PHALPlugin):
     """Keyboard hotkeys, define key combo to trigger listening"""
 
+    # emitted by the bus client when the connection is lost
+    bus_down_events = ("close", "reconnecting", "error")
+    # accepted by keyboard.subscribe
+    queue_overflow_policies = ("drop_oldest", "drop_newest")
+
     def __init__(self, bus=None, config=None):
+        # (event_type, scan_code or combo) -> [msg_type, ...]
+        # NOTE: the plugin thread is started by PHALPlugin.__init__
+        self.dispatch_index = {}
+        # (event_type, combo) registered with keyboard
+        self._watched = set()
+        # "messages" name -> (msg_type, data, context)
+        self.messages = {}
+        # add the keyboard event to the context of messages, see _event_context
+        self.event_context = False
+        self._sequence = count(1)
+        self.holds = HoldDetector(self.handle_hold)
+        self.taps = TapCounter(self.handle_taps, self.handle_single_taps)
+        self.repeats = RepeatLimiter()
+        # the bus is only used from the worker thread
+        self.worker = EmitWorker(self.send)
+        self.throttle = EmitThrottle(self.worker.put)
+        # "queue_overflow" once validated by register_callbacks
+        self._queue_overflow = "drop_oldest"
+        # set at the end of register_callbacks, run waits for it
+        self._configured = Event()
         super().__init__(bus=bus, name="ovos-PHAL-plugin-hotkeys", config=config)
         self.register_callbacks()
 
+    @staticmethod
+    def _iter_mappings(section):
+        """yield (msg_type, key) pairs, a mapping may list several keys"""
+        for msg_type, keys in section.items():
+            if not isinstance(keys, list):
+                keys = [keys]
+            for key in keys:
+                yield msg_type, key
+
+    def _iter_gestures(self, section):
+        """yield (msg_type, mapping) pairs for sections of dict mappings,
+        like {"key": 582, "hold_ms": 1500}, skipping invalid ones"""
+        for msg_type, mapping in self._iter_mappings(self.config.get(section, {})):
+            if not isinstance(mapping, dict) or "key" not in mapping:
+                LOG.error(f"invalid {section} mapping for {msg_type}, "
+                          f"expected a dict with a \"key\": {mapping}")
+                continue
+            yield msg_type, mapping
+
+    def _watch(self, event_type, key):
+        """make sure handle_trigger is called for (event_type, key)
+
+        scan codes are always seen in run, combos are registered once"""
+        if isinstance(key, int) or (event_type, key) in self._watched:
+            return
+        self._watched.add((event_type, key))
+        keyboard.add_hotkey(key, self.handle_trigger,
+                            args=(event_type, key),
+                            trigger_on_release=event_type == keyboard.KEY_UP,
+                            trigger_on_hold=event_type == keyboard.KEY_HOLD,
+                            pass_event=True,
+                            # if disabled, combos still match while unrelated keys are held
+                            exact=self.config.get("exact_match", True))
+
     def register_callbacks(self):
-        """combos are registered independently
-        NOTE: same combo can only have 1 callback (up or down)"""
-        for msg_type, key in self.config.get("key_down", {}).items():
-            if isinstance(key, int):
+        """compile "key_down" and "key_up" into a single dispatch index
+
+        integer scan codes are looked up directly for every event in run,
+        combos are registered once with keyboard and looked up when triggered
+        the same key or combo can be mapped to several bus messages"""
+        holds = list(self._iter_gestures("key_hold"))
+        taps = list(self._iter_gestures("key_multi_tap"))
+
+        queue_overflow = self.config.get("queue_overflow", "drop_oldest")
+        if queue_overflow in self.queue_overflow_policies:
+            self._queue_overflow = queue_overflow
+        else:
+            LOG.error(f"invalid queue_overflow {queue_overflow!r}, expected one of "
+                      f"{self.queue_overflow_policies}, using \"drop_oldest\"")
+
+        if self.config.get("filter_keys", True) and not self.config.get("debug"):
+            # only read the keys we care about from the input devices
+            keys = [key for section in ("key_down", "key_up")
+                    for _, key in self._iter_mappings(self.config.get(section, {}))]
+            keys += [mapping["key"] for _, mapping in holds + taps]
+            try:
+                keyboard.set_key_filter(keys)
+            except ValueError as e:
+                LOG.error(f"failed to filter input events, invalid key: {e}")
+
+        debounce_ms = self.config.get("debounce_ms", 0)
+        debounce_keys = self.config.get("debounce_keys")
+        if debounce_ms or debounce_keys:
+            # drop the bounces of mechanical buttons before they reach the listener
+            if debounce_keys is not None:
+                # json keys are always strings, numbers are scan codes
+                debounce_keys = {int(key) if str(key).isdigit() else key: window_ms / 1000
+                                 for key, window_ms in debounce_keys.items()}
+            try:
+                keyboard.set_debounce(debounce_ms / 1000, debounce_keys)
+            except ValueError as e:
+                LOG.error(f"failed to debounce input events, invalid key: {e}")
+
+        autorepeat_ms = self.config.get("autorepeat_delay_ms", 0)
+        if autorepeat_ms:
+            # gpio buttons don't repeat by themselves, keyboards are left alone
+            keyboard.set_autorepeat(autorepeat_ms / 1000,
+                                    self.config.get("autorepeat_interval_ms", 100) / 1000)
+
+        for event_type, section in ((keyboard.KEY_DOWN, "key_down"),
+                                    (keyboard.KEY_UP, "key_up")):
+            for msg_type, key in self._iter_mappings(self.config.get(section, {})):
+                self._watch(event_type, key)
+                self.dispatch_index.setdefault((event_type, key), []).append(msg_type)
+
+        for name, message in self.config.get("messages", {}).items():
+            if not isinstance(message, dict) or "type" not in message \
+                    or not isinstance(message.get("data", {}), dict) \
+                    or not isinstance(message.get("context", {}), dict):
+                LOG.error(f"invalid message {name}, expected a dict with a \"type\" "
+                          f"and optional \"data\" and \"context\" dicts: {message}")
                 continue
+            self.messages[name] = (message["type"], message.get("data") or {},
+                                   message.get("context") or {})
+
+        try:
+            self.worker.configure(self.config.get("emit_queue_size", 64),
+                                  self.config.get("emit_overflow", "drop_oldest"))
+        except ValueError as e:
+            LOG.error(f"invalid emit_overflow: {e}")
 
-            def do_emit(k=key, m=msg_type):
-                LOG.info(f"hotkey down {k} -> {m}")
-                self.bus.emit(Message(m))
+        offline_size = self.config.get("offline_buffer_size", 32)
+        if offline_size:
+            # keep presses made while the messagebus restarts
+            offline = OfflineBuffer(offline_size)
+            for msg_type, ttl_ms in self.config.get("offline_ttl_ms", {}).items():
+                offline.set_ttl(msg_type, ttl_ms)
+            self.worker.offline = offline
+            # the client only clears connected_event on close(), not when the
+            # connection drops, follow the bus events instead
+            if not self._bus_connected():
+                self.worker.disconnected()
+            self.bus.on("open", self.handle_bus_open)
+            for event in self.bus_down_events:
+                self.bus.on(event, self.handle_bus_close)
 
-            keyboard.add_hotkey(key, do_emit)
+        self.event_context = self.config.get("event_context", False)
 
-        for msg_type, key in self.config.get("key_up", {}).items():
-            if isinstance(key, int):
+        for msg_type, policy in self.config.get("emit_policy", {}).items():
+            if not isinstance(policy, dict):
+                LOG.error(f"invalid emit_policy for {msg_type}, expected a dict: {policy}")
                 continue
+            try:
+                self.throttle.add(msg_type, policy.get("mode"), policy.get("window_ms", 250),
+                                  policy.get("rate"), policy.get("burst", 1))
+            except ValueError as e:
+                LOG.error(f"invalid emit_policy for {msg_type}: {e}")
 
-            def do_emit(k=key, m=msg_type):
-                LOG.info(f"hotkey up {k} -> {m}")
-                self.bus.emit(Message(m))
+        repeat_policies = self.config.get("key_repeat", {})
+        for msg_type, key in self._iter_mappings(self.config.get("key_down", {})):
+            try:
+                self.repeats.add(key, msg_type, repeat_policies.get(msg_type, "pass"))
+            except ValueError as e:
+                LOG.error(f"invalid key_repeat for {msg_type}: {e}")
+                continue
+            if self.repeats.wants_repeats(key):
+                self._watch(keyboard.KEY_HOLD, key)
 
-            keyboard.add_hotkey(key, do_emit, trigger_on_release=True)
+        for msg_type, mapping in holds:
+            key = mapping["key"]
+            self._watch(keyboard.KEY_DOWN, key)
+            self._watch(keyboard.KEY_UP, key)
+            self.holds.add(key, msg_type, mapping.get("hold_ms", 1000))
 
-    def run(self):
-        self._running = True
+        for msg_type, mapping in taps:
+            key = mapping["key"]
+            self._watch(keyboard.KEY_DOWN, key)
+            self._watch(keyboard.KEY_UP, key)
+            self.taps.add(key, msg_type, mapping.get("taps", 2), mapping.get("window_ms", 300))
+
+        self._configured.set()
 
-        while self._running:
-            # Wait for the next event.
-            event = keyboard.read_event()
-            ev = json.loads(event.to_json())
-            scan_code = ev["scan_code"]
+    def handle_trigger(self, event_type, key, event=None):
+        """emit every bus message mapped to (event_type, key)
 
-            if event.event_type == keyboard.KEY_DOWN:
-                for msg_type, k in self.config.get("key_down", {}).items():
-                    if scan_code == k:
-                        LOG.info(f"hotkey down {scan_code} -> {msg_type}")
-                        self.bus.emit(Message(msg_type))
+        a key released after reaching a "key_hold" threshold was not a tap,
+        its "key_up" mappings are skipped
+        keys with "key_multi_tap" mappings wait for the tap window to end,
+        their autorepeats are ignored"""
+        if event_type == keyboard.KEY_HOLD:
+            if key not in self.taps.taps:
+                self.handle_repeat(key, event)
+            return
+        if event_type == keyboard.KEY_DOWN:
+            self.holds.press(key, event)
+            if self.taps.press(key, event):
+                return
+            self.repeats.press(key)
+        else:
+            tap_pending = self.taps.release(key)
+            if self.holds.release(key) or tap_pending:
+                return
+        self._dispatch(event_type, key, event)
 
-            if event.event_type == keyboard.KEY_UP:
-                for msg_type, k in self.config.get("key_up", {}).items():
-                    if scan_code == k:
-                        LOG.info(f"hotkey up {scan_code} -> {msg_type}")
-                        self.bus.emit(Message(msg_type))
+    def _dispatch(self, event_type, key, event=None):
+        for msg_type in self.dispatch_index.get((event_type, key), ()):
+            LOG.info(f"hotkey {event_type} {key} -> {msg_type}")
+            self.emit(msg_type, event)
 
-            if self.config.get("debug"):
-                LOG.info(f"{event.event_type} - {ev}")
+    def handle_repeat(self, key, event=None):
+        """emit the "key_down" mappings of a held key, per their "key_repeat" policy"""
+        for msg_type in self.repeats.repeat(key):
+            LOG.debug(f"hotkey repeat {key} -> {msg_type}")
+            self.emit(msg_type, event)
+
+    def handle_hold(self, msg_type, event=None):
+        LOG.info(f"hotkey hold -> {msg_type}")
+        self.emit(msg_type, event)
+
+    def handle_taps(self, msg_types, event=None):
+        for msg_type in msg_types:
+            LOG.info(f"hotkey multi tap -> {msg_type}")
+            self.emit(msg_type, event)
+
+    def handle_single_taps(self, key, count, released, events=()):
+        """the taps of a key were not a mapped multi tap, emit its plain
+        mappings for each of them, the last release may still be ahead
+
+        events are the press events of the taps, if known"""
+        events = list(events) or [None] * count
+        for tap in range(count):
+            self._dispatch(keyboard.KEY_DOWN, key, events[tap])
+            if released or tap < count - 1:
+                self._dispatch(keyboard.KEY_UP, key, events[tap])
+
+    def emit(self, msg_type, event=None):
+        """emit msg_type, subject to its "emit_policy" if any
+
+        event is the keyboard event that triggered it, if known"""
+        context = self._event_context(event) if self.event_context else None
+        self.throttle.trigger(msg_type, context)
+
+    def _event_context(self, event):
+        """where a message comes from, for latency tracking
+
+        time_ns is the kernel timestamp of the key event from the monotonic
+        clock, compare it with time.monotonic_ns() on the same device
+        seq numbers every trigger, gaps are triggers coalesced or dropped on the way"""
+        context = {"seq": next(self._sequence)}
+        if event is not None:
+            context["time_ns"] = event.time_ns
+            context["scan_code"] = event.scan_code
+            context["device"] = event.device
+        return {"hotkey": context}
+
+    def _bus_connected(self):
+        connected = getattr(self.bus, "connected_event", None)
+        return connected is None or connected.is_set()
+
+    def handle_bus_open(self, message=None):
+        LOG.debug(f"messagebus connected, sending {len(self.worker.offline)} held messages")
+        self.worker.reconnected()
+
+    def handle_bus_close(self, message=None):
+        LOG.debug("messagebus disconnected, holding messages")
+        self.worker.disconnected()
+
+    def send(self, msg_type, data=None, context=None):
+        """send msg_type, a name from "messages" or a plain message type"""
+        if msg_type in self.messages:
+            msg_type, static_data, static_context = self.messages[msg_type]
+            data = dict(static_data, **data) if data else dict(static_data)
+            context = dict(static_context, **context) if context else dict(static_context)
+        self.bus.emit(Message(msg_type, data, context))
+
+    def run(self):
+        self._running = True
+        debug = self.config.get("debug")
+        dropped = 0
+        emit_dropped = 0
+
+        # the keyboard listener starts with the subscription, once the keys
+        # are filtered
+        while not self._configured.wait(0.5):
+            if not self._running:
+                return
+        with keyboard.subscribe(maxsize=self.config.get("queue_size", 256),
+                                overflow_policy=self._queue_overflow) as events:
+            while self._running:
+                # Wait for the next event, waking up periodically to
+                # notice shutdown.
+                event = events.get(timeout=0.5)
+                if self.worker.dropped != emit_dropped:
+                    LOG.warning(f"hotkeys bus queue full, dropped {self.worker.dropped - emit_dropped} "
+                                f"messages, {self.worker.stats()}")
+                    emit_dropped = self.worker.dropped
+                if event is None:
+                    continue
+                self.handle_trigger(event.event_type, event.scan_code, event)
+
+                if events.dropped != dropped:
+                    LOG.warning(f"hotkeys event queue full, dropped {events.dropped - dropped} events")
+                    dropped = events.dropped
+                if debug:
+                    LOG.info(f"{event.event_type} - {event.to_json()}")
 
     def shutdown(self):
+        self._running = False
+        self.holds.clear()
+        self.taps.clear()
+        self.repeats.clear()
+        self.throttle.clear()
         keyboard.unhook_all_hotkeys()
+        keyboard.close_output()
+        if self.worker.offline is not None:
+            self.bus.remove("open", self.handle_bus_open)
+            for event in self.bus_down_events:
+                self.bus.remove(event, self.handle_bus_close)
+        self.worker.close()
         super().shutdown()
-
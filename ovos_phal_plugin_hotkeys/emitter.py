@@ -0,0 +1,350 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+from ovos_utils.log import LOG
+
+import ovos_phal_plugin_hotkeys.keyboard as keyboard
+
+
+class _EmitSlot:
+    """emission state of a single message type"""
+    __slots__ = ("mode", "window", "rate", "burst", "tokens", "stamp",
+                 "window_end", "pending", "context", "timer", "dropped")
+
+    def __init__(self, mode, window, rate, burst, stamp):
+        self.mode = mode
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        # clock time the tokens were counted at
+        self.stamp = stamp
+        self.window_end = 0
+        self.pending = 0
+        # of the last coalesced trigger
+        self.context = None
+        self.timer = None
+        self.dropped = 0
+
+
+class EmitThrottle:
+    """limit how often each message type is emitted
+
+    "leading" emits the first trigger and drops the others for a window,
+    "coalesce" emits the first one too and the others as a single message
+    with their "count" in the data once the window ends
+    a token bucket caps the rate of a message type on top of that, dropped
+    triggers are counted, coalesced ones wait for a token instead
+    message types without a policy are emitted right away
+    windows are timed on the scheduler, the one of keyboard by default"""
+
+    modes = (None, "leading", "coalesce")
+
+    def __init__(self, emit, scheduler=None):
+        # called with (msg_type, data, context) for every message to send
+        self.emit = emit
+        self.scheduler = keyboard.get_scheduler() if scheduler is None else scheduler
+        # msg_type -> _EmitSlot
+        self.slots = {}
+        self._lock = Lock()
+
+    def add(self, msg_type, mode=None, window_ms=250, rate=None, burst=1):
+        if mode not in self.modes:
+            raise ValueError(f"invalid mode {mode!r}, expected \"leading\" or \"coalesce\"")
+        if rate is not None and (not isinstance(rate, (int, float)) or rate <= 0):
+            raise ValueError(f"invalid rate {rate!r}, expected messages per second")
+        if not isinstance(burst, int) or burst < 1:
+            raise ValueError(f"invalid burst {burst!r}, expected a positive integer")
+        self.slots[msg_type] = _EmitSlot(mode, window_ms / 1000, rate, burst, self.scheduler.clock())
+
+    @staticmethod
+    def _take(slot, now):
+        """take a token from the bucket of slot, False if empty"""
+        if slot.rate is None:
+            return True
+        slot.tokens = min(slot.burst, slot.tokens + (now - slot.stamp) * slot.rate)
+        slot.stamp = now
+        if slot.tokens < 1:
+            return False
+        slot.tokens -= 1
+        return True
+
+    def trigger(self, msg_type, context=None):
+        slot = self.slots.get(msg_type)
+        if slot is None:
+            self.emit(msg_type, None, context)
+            return
+        now = self.scheduler.clock()
+        with self._lock:
+            if slot.mode is not None and now < slot.window_end:
+                if slot.mode == "leading":
+                    slot.dropped += 1
+                    return
+                slot.pending += 1
+                slot.context = context
+                if slot.timer is None:
+                    slot.timer = self.scheduler.call_later(slot.window_end - now, self._flush,
+                                                           (msg_type, slot))
+                return
+            if not self._take(slot, now):
+                slot.dropped += 1
+                return
+            slot.window_end = now + slot.window
+        self.emit(msg_type, None, context)
+
+    def _flush(self, msg_type, slot):
+        with self._lock:
+            slot.timer = None
+            if not slot.pending:
+                return
+            now = self.scheduler.clock()
+            if not self._take(slot, now):
+                # keep counting until the bucket has a token again
+                slot.timer = self.scheduler.call_later((1 - slot.tokens) / slot.rate, self._flush,
+                                                       (msg_type, slot))
+                return
+            count, context = slot.pending, slot.context
+            slot.pending = 0
+            slot.context = None
+            # later triggers are coalesced again
+            slot.window_end = now + slot.window
+        self.emit(msg_type, {"count": count}, context)
+
+    def dropped(self):
+        """msg_type -> number of triggers dropped so far"""
+        return {msg_type: slot.dropped for msg_type, slot in self.slots.items()}
+
+    def clear(self):
+        with self._lock:
+            for slot in self.slots.values():
+                if slot.timer is not None:
+                    slot.timer.cancel()
+                    slot.timer = None
+                slot.pending = 0
+                slot.context = None
+
+
+class OfflineBuffer:
+    """hold messages while the bus is disconnected, to send them once it's back
+
+    a ring of at most maxsize messages, the oldest is dropped when full
+    each message type can have a time to live, after which it is stale and
+    dropped, like a listen request that no longer makes sense a minute later
+    message types without one are kept until sent or pushed out
+    clock must be the one of the EmitWorker, that stamps the messages"""
+
+    def __init__(self, maxsize=32, clock=monotonic):
+        self.maxsize = maxsize
+        # returns the current time in seconds
+        self.clock = clock
+        # msg_type -> seconds
+        self.ttls = {}
+        self.dropped = 0
+        self.expired = 0
+        # (msg_type, data, clock time of put, context, expiry or None)
+        self._messages = deque()
+
+    def set_ttl(self, msg_type, ttl_ms):
+        self.ttls[msg_type] = ttl_ms / 1000
+
+    def add(self, msg_type, data, queued, context):
+        ttl = self.ttls.get(msg_type)
+        expires = None if ttl is None else queued + ttl
+        if len(self._messages) >= self.maxsize:
+            self._messages.popleft()
+            self.dropped += 1
+        self._messages.append((msg_type, data, queued, context, expires))
+
+    def drain(self):
+        """returns the [msg_type, data, queued, context] still alive, oldest first"""
+        now = self.clock()
+        messages = []
+        while self._messages:
+            msg_type, data, queued, context, expires = self._messages.popleft()
+            if expires is not None and expires <= now:
+                self.expired += 1
+                continue
+            messages.append([msg_type, data, queued, context])
+        return messages
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class EmitWorker:
+    """send bus messages from a dedicated thread
+
+    keyboard threads only queue messages, a slow or reconnecting bus never
+    blocks them, when the queue is full a message is dropped, the oldest or
+    the newest, or with "coalesce" merged into a queued one of the same type
+    by adding up their "count" (the oldest is dropped if there is none)
+    between disconnected() and reconnected() messages go to the offline
+    buffer instead
+    if threaded is false no thread is started and queued messages are only
+    sent when run_pending() is called, which with a fake clock makes tests
+    deterministic"""
+
+    overflow_policies = ("drop_oldest", "drop_newest", "coalesce")
+
+    def __init__(self, send, maxsize=64, overflow_policy="drop_oldest",
+                 clock=monotonic, threaded=True):
+        # called with (msg_type, data, context) from the worker thread
+        self.send = send
+        # returns the current time in seconds
+        self.clock = clock
+        self.threaded = threaded
+        # cleared by disconnected(), set again by reconnected()
+        self.online = True
+        # OfflineBuffer, None to wait for the bus to come back instead
+        self.offline = None
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        # seconds from put to sent
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.closed = False
+        self.thread = None
+        # [msg_type, data, clock time of put, context]
+        self._queue = deque()
+        self._not_empty = Condition(Lock())
+
+    def configure(self, maxsize, overflow_policy):
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError(f"unknown overflow policy {overflow_policy!r}, "
+                             f"expected one of {self.overflow_policies}")
+        with self._not_empty:
+            self.maxsize = maxsize
+            self.overflow_policy = overflow_policy
+
+    @staticmethod
+    def _merge(data, other):
+        merged = dict(data or {})
+        merged["count"] = merged.get("count", 1) + (other or {}).get("count", 1)
+        return merged
+
+    def _overflow(self, msg_type, data):
+        """make room for a message, returns False if it was dropped or merged"""
+        if self.overflow_policy == "coalesce":
+            for queued in reversed(self._queue):
+                if queued[0] == msg_type:
+                    queued[1] = self._merge(queued[1], data)
+                    self.coalesced += 1
+                    return False
+        self.dropped += 1
+        if self.overflow_policy == "drop_newest":
+            return False
+        self._queue.popleft()
+        return True
+
+    def put(self, msg_type, data=None, context=None):
+        with self._not_empty:
+            if self.closed:
+                return
+            if self.maxsize and len(self._queue) >= self.maxsize \
+                    and not self._overflow(msg_type, data):
+                return
+            self._queue.append([msg_type, data, self.clock(), context])
+            if self.threaded and self.thread is None:
+                self.thread = Thread(target=self._run, name="hotkeys bus emitter", daemon=True)
+                self.thread.start()
+            self._not_empty.notify()
+
+    def _pop(self):
+        """the next queued message, None if it went to the offline buffer
+        must be called with the lock held"""
+        message = self._queue.popleft()
+        if self.offline is not None and not self.online:
+            self.offline.add(*message)
+            return None
+        return message
+
+    def _send(self, msg_type, data, queued, context):
+        try:
+            self.send(msg_type, data, context)
+        except Exception as e:
+            self.failed += 1
+            LOG.error(f"failed to emit {msg_type}: {e}")
+            return
+        latency = self.clock() - queued
+        self.sent += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def _run(self):
+        while True:
+            with self._not_empty:
+                while not self._queue and not self.closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                message = self._pop()
+            if message is not None:
+                self._send(*message)
+
+    def run_pending(self):
+        """send the queued messages from the calling thread, when not threaded"""
+        while True:
+            with self._not_empty:
+                if not self._queue:
+                    return
+                message = self._pop()
+            if message is not None:
+                self._send(*message)
+
+    def disconnected(self):
+        """hold messages in the offline buffer until reconnected()"""
+        with self._not_empty:
+            self.online = False
+
+    def reconnected(self):
+        """send the messages held while offline, before any newer one"""
+        with self._not_empty:
+            self.online = True
+            if self.offline is None:
+                return
+            messages = self.offline.drain()
+            self._queue.extendleft(reversed(messages))
+            if messages:
+                self._not_empty.notify()
+
+    def stats(self):
+        """counters for monitoring, latencies in milliseconds"""
+        sent = self.sent
+        offline = self.offline
+        has_offline = offline is not None
+        return {"depth": len(self._queue),
+                "offline": len(offline) if has_offline else 0,
+                "offline_dropped": offline.dropped if has_offline else 0,
+                "offline_expired": offline.expired if has_offline else 0,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "sent": sent,
+                "failed": self.failed,
+                "latency_avg_ms": self.latency_total / sent * 1000 if sent else 0.0,
+                "latency_max_ms": self.latency_max * 1000}
+
+    def close(self, timeout=1.0):
+        """stop accepting messages, the queued ones are still sent for up to
+        timeout seconds"""
+        with self._not_empty:
+            self.closed = True
+            self._not_empty.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -0,0 +1,262 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from threading import Lock
+from time import monotonic
+
+import ovos_phal_plugin_hotkeys.keyboard as keyboard
+
+
+class HoldDetector:
+    """call back when a key is held down longer than a threshold
+
+    keys are scan codes or combos, each with any number of thresholds
+    a single timer per held key runs on the scheduler, the one of keyboard
+    by default, it is re-armed for the next threshold when it fires and
+    cancelled on release"""
+
+    def __init__(self, on_hold, scheduler=None):
+        # called with (msg_type, press event) for every threshold reached
+        self.on_hold = on_hold
+        self.scheduler = keyboard.get_scheduler() if scheduler is None else scheduler
+        # key -> [(hold seconds, msg_type), ...] sorted by hold time
+        self.thresholds = {}
+        # key -> [timer of the next threshold, press event] for each held key,
+        # the list identifies the press so a late timer can't fire for the next one
+        self._held = {}
+        # keys that reached at least one threshold since pressed
+        self._fired = set()
+        self._lock = Lock()
+
+    def add(self, key, msg_type, hold_ms):
+        self.thresholds.setdefault(key, []).append((hold_ms / 1000, msg_type))
+        self.thresholds[key].sort(key=lambda t: t[0])
+
+    def press(self, key, event=None):
+        """start timing a key, repeated presses while held are ignored"""
+        thresholds = self.thresholds.get(key)
+        if not thresholds:
+            return
+        with self._lock:
+            if key in self._held:
+                return
+            press = self._held[key] = [None, event]
+            press[0] = self.scheduler.call_later(thresholds[0][0], self._fire, (key, press, 0))
+
+    def release(self, key):
+        """stop timing a key, returns True if it was held long enough to fire"""
+        if key not in self.thresholds:
+            return False
+        with self._lock:
+            press = self._held.pop(key, None)
+            if press is not None and press[0] is not None:
+                press[0].cancel()
+            if key in self._fired:
+                self._fired.discard(key)
+                return True
+        return False
+
+    def _fire(self, key, press, index):
+        thresholds = self.thresholds[key]
+        with self._lock:
+            if self._held.get(key) is not press:
+                return  # released meanwhile
+            self._fired.add(key)
+            if index + 1 < len(thresholds):
+                delay = thresholds[index + 1][0] - thresholds[index][0]
+                press[0] = self.scheduler.call_later(delay, self._fire, (key, press, index + 1))
+            else:
+                press[0] = None
+        self.on_hold(thresholds[index][1], press[1])
+
+    def clear(self):
+        with self._lock:
+            for press in self._held.values():
+                if press[0] is not None:
+                    press[0].cancel()
+            self._held.clear()
+            self._fired.clear()
+
+
+class _TapState:
+    __slots__ = ("count", "events", "timer", "held", "swallow_up")
+
+    def __init__(self):
+        self.count = 0
+        # the press event of each tap
+        self.events = []
+        self.timer = None
+        self.held = False
+        self.swallow_up = False
+
+
+class TapCounter:
+    """count quick successive presses of a key, like a double tap
+
+    only keys with multi tap mappings are counted, each with one state and at
+    most one timer on the scheduler, a tap restarts the window and the taps
+    are resolved once it expires, or right away when reaching the highest
+    mapped count
+    plain mappings of counted keys are deferred until then, other keys are
+    not delayed at all"""
+
+    def __init__(self, on_taps, on_single, scheduler=None):
+        # called with (msg_types mapped to the number of taps, last press event)
+        self.on_taps = on_taps
+        # called with (key, count, released, press events) when the taps are
+        # not mapped, to replay the plain mappings of the key count times
+        self.on_single = on_single
+        self.scheduler = keyboard.get_scheduler() if scheduler is None else scheduler
+        # key -> {taps: [msg_type, ...]}
+        self.taps = {}
+        # key -> (window seconds, highest mapped count)
+        self.windows = {}
+        self._state = {}
+        self._lock = Lock()
+
+    def add(self, key, msg_type, taps, window_ms):
+        self.taps.setdefault(key, {}).setdefault(taps, []).append(msg_type)
+        window, max_taps = self.windows.get(key, (0, 0))
+        self.windows[key] = (max(window, window_ms / 1000), max(max_taps, taps))
+
+    def press(self, key, event=None):
+        """count a press, returns True if its mappings must wait for the taps
+        to be resolved"""
+        if key not in self.taps:
+            return False
+        window, max_taps = self.windows[key]
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                state = self._state[key] = _TapState()
+            elif state.held:
+                return True  # repeated while held
+            state.held = True
+            state.count += 1
+            state.events.append(event)
+            if state.timer is not None:
+                state.timer.cancel()
+                state.timer = None
+            count = state.count
+            if count < max_taps:
+                state.timer = self.scheduler.call_later(window, self._expire, (key, state))
+                return True
+            events, state.events = state.events, []
+            state.count = 0
+            state.swallow_up = True
+        self._resolve(key, count, released=False, events=events)
+        return True
+
+    def release(self, key):
+        """returns True if the release must not trigger plain mappings"""
+        if key not in self.taps:
+            return False
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                return False
+            state.held = False
+            if state.count:
+                return True  # resolved later, as a released tap
+            del self._state[key]
+            return state.swallow_up
+
+    def _expire(self, key, state):
+        with self._lock:
+            if self._state.get(key) is not state or not state.count:
+                return
+            count = state.count
+            events, state.events = state.events, []
+            released = not state.held
+            state.count = 0
+            state.timer = None
+            if state.held:
+                # the release of a mapped multi tap is part of it, the one of
+                # a single tap goes through the plain mappings
+                state.swallow_up = count in self.taps[key]
+            else:
+                del self._state[key]
+        self._resolve(key, count, released, events)
+
+    def _resolve(self, key, count, released, events):
+        if count in self.taps[key]:
+            self.on_taps(self.taps[key][count], events[-1])
+        else:
+            self.on_single(key, count, released, events)
+
+    def clear(self):
+        with self._lock:
+            for state in self._state.values():
+                if state.timer is not None:
+                    state.timer.cancel()
+            self._state.clear()
+
+
+class RepeatLimiter:
+    """decide which autorepeats of a held key reach the bus
+
+    each "key_down" mapping has its own policy, "pass" emits every repeat,
+    "ignore" none and a number is the most repeats per second to emit"""
+
+    def __init__(self, clock=monotonic):
+        # returns the current time in seconds
+        self.clock = clock
+        # key -> [(msg_type, seconds between repeats or None to ignore)]
+        self.policies = {}
+        # (key, msg_type) -> clock time of the last emit, for throttled mappings
+        self._last = {}
+        self._lock = Lock()
+
+    def add(self, key, msg_type, policy):
+        if policy == "pass":
+            interval = 0
+        elif policy == "ignore":
+            interval = None
+        elif isinstance(policy, (int, float)) and not isinstance(policy, bool) and policy > 0:
+            interval = 1 / policy
+        else:
+            raise ValueError(f"invalid repeat policy {policy!r}, expected "
+                             f"\"pass\", \"ignore\" or repeats per second")
+        self.policies.setdefault(key, []).append((msg_type, interval))
+
+    def wants_repeats(self, key):
+        return any(interval is not None for _, interval in self.policies.get(key, ()))
+
+    def press(self, key):
+        """the press itself was emitted, throttled repeats count from it"""
+        if key not in self.policies:
+            return
+        now = self.clock()
+        with self._lock:
+            for msg_type, interval in self.policies[key]:
+                if interval:
+                    self._last[(key, msg_type)] = now
+
+    def repeat(self, key):
+        """returns the msg_types to emit for an autorepeat of key"""
+        msg_types = []
+        now = self.clock()
+        with self._lock:
+            for msg_type, interval in self.policies.get(key, ()):
+                if interval is None:
+                    continue
+                if interval:
+                    last = self._last.get((key, msg_type))
+                    if last is not None and now - last < interval:
+                        continue
+                    self._last[(key, msg_type)] = now
+                msg_types.append(msg_type)
+        return msg_types
+
+    def clear(self):
+        with self._lock:
+            self._last.clear()
@@ -4,16 +4,19 @@ version = '1.0.0'
 
 import re as _re
 import itertools as _itertools
+import bisect as _bisect
 import collections as _collections
-from threading import Thread as _Thread, Lock as _Lock
+from threading import Lock as _Lock, RLock as _RLock, Condition as _Condition
 import time as _time
 import random
 import queue as _queue
 import platform as _platform
+from contextlib import nullcontext as _nullcontext
 from threading import Event as _UninterruptibleEvent
 
-from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP
+from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP, KEY_HOLD
 from ._generic import GenericListener as _GenericListener
+from ._scheduler import Scheduler as _Scheduler
 from ._canonical_names import all_modifiers, sided_modifiers, normalize_name
 
 _is_str = lambda x: isinstance(x, str)
@@ -62,7 +65,322 @@ _pressed_events_lock = _Lock()
 _pressed_events = {}
 _physically_pressed_keys = _pressed_events
 _logically_pressed_keys = {}
+
+# Single thread for all timed calls, see `call_later`.
+_scheduler = _Scheduler()
+
+_other_scan_code_bits = {}
+def _scan_code_bit(scan_code):
+    """
+    Returns the bit representing `scan_code` in chord and pressed keys masks.
+    Non-negative scan codes take the even bits, others (negative on some
+    platforms) an odd bit assigned on first use.
+    """
+    if isinstance(scan_code, int) and scan_code >= 0:
+        return 1 << (scan_code << 1)
+    if scan_code not in _other_scan_code_bits:
+        _other_scan_code_bits[scan_code] = len(_other_scan_code_bits)
+    return 1 << (_other_scan_code_bits[scan_code] << 1 | 1)
+
+def _chord_mask(scan_codes):
+    mask = 0
+    for scan_code in scan_codes:
+        mask |= _scan_code_bit(scan_code)
+    return mask
+
+def _with_pressed(pressed, scan_code, is_down):
+    """
+    Returns a copy of the `(chord, mask)` pair from `_KeyboardListener.pressed`
+    with `scan_code` pressed or released. `chord` is the sorted tuple of
+    pressed scan codes, `mask` their `_chord_mask`.
+    """
+    chord, mask = pressed
+    if (scan_code in chord) == is_down:
+        return pressed
+    if is_down:
+        index = _bisect.bisect(chord, scan_code)
+        chord = chord[:index] + (scan_code,) + chord[index:]
+    else:
+        index = chord.index(scan_code)
+        chord = chord[:index] + chord[index+1:]
+    mask ^= _scan_code_bit(scan_code)
+    return chord, mask
+
+class _ChordIndex(object):
+    """
+    Hotkey handlers by chord, matched against the pressed keys mask. A chord
+    is a hotkey step as returned by `parse_hotkey`, a list of keys each with
+    its set of alternative scan codes (e.g. left and right shift), and it
+    matches when at least one scan code of each key is pressed.
+
+    Each chord is indexed by all its scan codes, so an event only checks the
+    chords its key is part of. Keys with a single scan code are checked all at
+    once with a single mask comparison, only keys with alternatives one by one.
+
+    Chords added with `exact=True` match only if no other key is pressed,
+    otherwise they match as long as all their keys are pressed. Chords added
+    with a `guard` only match while `guard()` is true.
+    """
+    def __init__(self):
+        # scan code -> list of (chord, required, alternatives, union, exact, handler, guard)
+        self.by_scan_code = _collections.defaultdict(list)
+
+    @staticmethod
+    def normalize(chord):
+        """ Sorted tuple of sorted scan code tuples, accepting plain scan codes for single keys. """
+        return tuple(sorted(tuple(sorted(set(key))) if _is_list(key) else (key,) for key in chord))
+
+    def add(self, chord, handler, exact=True, guard=None):
+        chord = self.normalize(chord)
+        key_masks = [_chord_mask(key) for key in chord]
+        required = _chord_mask(key[0] for key in chord if len(key) == 1)
+        alternatives = tuple(mask for key, mask in zip(chord, key_masks) if len(key) > 1)
+        union = _chord_mask(scan_code for key in chord for scan_code in key)
+        entry = (chord, required, alternatives, union, exact, handler, guard)
+        for scan_code in set(scan_code for key in chord for scan_code in key):
+            self.by_scan_code[scan_code].append(entry)
+
+    def remove(self, chord, handler):
+        chord = self.normalize(chord)
+        for scan_code in set(scan_code for key in chord for scan_code in key):
+            entries = self.by_scan_code[scan_code]
+            for i, entry in enumerate(entries):
+                if entry[0] == chord and entry[5] == handler:
+                    del entries[i]
+                    break
+            if not entries:
+                del self.by_scan_code[scan_code]
+
+    def match(self, scan_code, pressed):
+        """
+        Returns the handlers of chords containing `scan_code` that match the
+        `pressed` mask, which must include `scan_code` itself.
+        """
+        if scan_code not in self.by_scan_code:
+            return []
+        return [handler for chord, required, alternatives, union, exact, handler, guard in self.by_scan_code[scan_code]
+                if pressed & required == required
+                and not (exact and pressed & ~union)
+                and all(pressed & mask for mask in alternatives)
+                and (guard is None or guard())]
+
+    def __getitem__(self, chord):
+        """ Returns the handlers registered for exactly this chord. """
+        chord = self.normalize(chord)
+        if not chord or chord[0][0] not in self.by_scan_code:
+            return []
+        return [entry[5] for entry in self.by_scan_code[chord[0][0]] if entry[0] == chord]
+
+    def values(self):
+        """ Returns the lists of handlers of each registered chord. """
+        handlers = _collections.OrderedDict()
+        seen = set()
+        for entries in self.by_scan_code.values():
+            for entry in entries:
+                if id(entry) not in seen:
+                    seen.add(id(entry))
+                    handlers.setdefault(entry[0], []).append(entry[5])
+        return list(handlers.values())
+
+    def __bool__(self):
+        return bool(self.by_scan_code)
+
+    def clear(self):
+        self.by_scan_code.clear()
+
+class _SequenceNode(object):
+    """ Node of `_Sequences`, reached after matching the steps on its path. """
+    def __init__(self):
+        # (chord, exact) -> _SequenceNode for the next step.
+        self.children = _collections.OrderedDict()
+        # Modifiers in the chords of the children, see `_Sequences.filters`.
+        self.modifiers = frozenset()
+        # Hotkeys with a step leading to this node, and the ones ending here.
+        self.hotkeys = []
+        self.final = []
+
+class _Sequences(object):
+    """
+    Multi-step hotkeys (e.g. 'ctrl+a, b') with the same `suppress`, compiled
+    into a single trie of steps, so each event advances all hotkeys in one
+    pass. The chord of every edge is registered once, when hotkeys are added,
+    and only matches while it follows the current node: stepping through the
+    trie never touches the hotkey indexes. Events that can't continue any
+    hotkey reset to the root and, if suppressing, the keys held back so far
+    are replayed. One timer resets the trie when the next step takes too long.
+    """
+    def __init__(self, suppress):
+        self.suppress = suppress
+        self.lock = _RLock()
+        self.root = _SequenceNode()
+        self.node = self.root
+        self.suppressed_events = []
+        # (chord, exact) -> [number of edges with it, function removing its handler]
+        self.edges = {}
+        # Scan codes and event types of the next steps, to detect misses.
+        self.allowed = set()
+        self.miss_types = set()
+        self.deadline = None
+        self.timer = None
+        self.generation = 0
+
+    def add(self, steps, callback, event_type, timeout, exact):
+        """
+        Adds a hotkey, returning the function to remove it. `callback` is
+        called with the event completing the last step.
+        """
+        hotkey = _State()
+        hotkey.callback = callback
+        hotkey.event_type = event_type
+        hotkey.timeout = timeout
+        hotkey.path = [self.root]
+        hotkey.keys = [(_ChordIndex.normalize(step), exact) for step in steps]
+        with self.lock:
+            node = self.root
+            for key in hotkey.keys:
+                if key not in node.children:
+                    node.children[key] = _SequenceNode()
+                    self._add_edge(node, key)
+                node = node.children[key]
+                hotkey.path.append(node)
+            for node in hotkey.path:
+                node.hotkeys.append(hotkey)
+            node.final.append(hotkey)
+            self._arm(self.node)
+        return lambda: self._remove(hotkey)
+
+    def _remove(self, hotkey):
+        with self.lock:
+            hotkey.path[-1].final.remove(hotkey)
+            for node in hotkey.path:
+                node.hotkeys.remove(hotkey)
+            for i, (parent, key, node) in enumerate(zip(hotkey.path, hotkey.keys, hotkey.path[1:])):
+                if not node.hotkeys:
+                    # The rest of the path only led to this hotkey.
+                    del parent.children[key]
+                    self._update_modifiers(parent)
+                    for key in hotkey.keys[i:]:
+                        self._remove_edge(key)
+                    break
+            if not self.node.hotkeys:
+                self.suppressed_events = []
+                self._arm(self.root)
+            else:
+                self._arm(self.node)
+
+    @staticmethod
+    def _update_modifiers(node):
+        node.modifiers = frozenset(scan_code for chord, exact in node.children
+                                   for key in chord for scan_code in key if is_modifier(scan_code))
+
+    def _add_edge(self, node, key):
+        self._update_modifiers(node)
+        if key in self.edges:
+            self.edges[key][0] += 1
+            return
+        # Like `_add_hotkey_step`, but modifiers are reported by `filters`
+        # for the current node only.
+        chord, exact = key
+        container = _listener.blocking_hotkeys if self.suppress else _listener.nonblocking_hotkeys
+        handler = lambda event: self._step(key, event)
+        container.add(chord, handler, exact, guard=lambda: key in self.node.children)
+        self.edges[key] = [1, lambda: container.remove(chord, handler)]
+
+    def _remove_edge(self, key):
+        edge = self.edges[key]
+        edge[0] -= 1
+        if not edge[0]:
+            del self.edges[key]
+            edge[1]()
+
+    def filters(self, scan_code):
+        """ If `scan_code` is a modifier of the next steps, like `filtered_modifiers`. """
+        return scan_code in self.node.modifiers
+
+    def _arm(self, node):
+        """ Makes `node` the current one, so the chords of its children match. """
+        self.node = node
+        self.allowed = set(scan_code for chord, exact in node.children for key in chord for scan_code in key)
+        self.miss_types = set(hotkey.event_type for hotkey in node.hotkeys)
+
+        self.generation += 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        timeouts = [hotkey.timeout for hotkey in node.hotkeys]
+        if node is self.root or not all(timeouts):
+            self.deadline = None
+        else:
+            self.deadline = _scheduler.clock() + max(timeouts)
+            self.timer = _scheduler.call_at(self.deadline, self._expire, (self.generation,))
+
+    def _reset(self):
+        events = self.suppressed_events
+        self.suppressed_events = []
+        self._arm(self.root)
+        if self.suppress:
+            for event in events:
+                if event.event_type == KEY_UP:
+                    release(event.scan_code)
+                else:
+                    press(event.scan_code)
+
+    def _expire(self, generation):
+        with self.lock:
+            if generation == self.generation and self.node is not self.root:
+                self._reset()
+
+    def catch_miss(self, event):
+        """
+        Resets to the root if `event` can't continue any hotkey, or the next
+        step took too long. Must be called with every event before matching
+        chords.
+        """
+        if self.node is self.root:
+            return
+        with self.lock:
+            if self.node is self.root:
+                return
+            if (event.event_type in self.miss_types and event.scan_code not in self.allowed) or (
+                    self.deadline is not None and _scheduler.clock() >= self.deadline):
+                self._reset()
+
+    def _step(self, key, event):
+        with self.lock:
+            child = self.node.children.get(key)
+            if child is None:
+                # Matched just before another event moved the current node.
+                return True
+            if event.event_type == KEY_UP:
+                self._arm(child if child.children else self.root)
+
+            results = [hotkey.callback(event) for hotkey in child.final if hotkey.event_type == event.event_type]
+            if any(results):
+                # Callbacks may ask for the keys to go through.
+                self._reset()
+                return True
+            if child.children:
+                self.suppressed_events.append(event)
+            elif self.node is not self.root:
+                self.suppressed_events[:] = [event]
+            else:
+                self.suppressed_events = []
+            return False
+
+    def clear(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            for count, remove in self.edges.values():
+                remove()
+            self.__init__(self.suppress)
+
 class _KeyboardListener(_GenericListener):
+    # Physically pressed keys as `(chord, mask)`, see `_with_pressed`. The
+    # listener thread replaces the whole tuple, so it can be read anywhere
+    # without taking `_pressed_events_lock`.
+    pressed = ((), 0)
+
     transition_table = {
         #Current state of the modifier, per `modifier_states`.
         #|
@@ -84,6 +402,11 @@ class _KeyboardListener(_GenericListener):
         ('suppressed', KEY_DOWN, 'modifier'): (False, False, 'suppressed'),
         ('allowed',    KEY_UP,   'modifier'): (False, True,  'free'),
         ('allowed',    KEY_DOWN, 'modifier'): (False, True,  'allowed'),
+        # Holding a modifier alone doesn't tell if it's part of a hotkey yet.
+        ('free',       KEY_HOLD, 'modifier'): (False, True,  'free'),
+        ('pending',    KEY_HOLD, 'modifier'): (False, False, 'pending'),
+        ('suppressed', KEY_HOLD, 'modifier'): (False, False, 'suppressed'),
+        ('allowed',    KEY_HOLD, 'modifier'): (False, True,  'allowed'),
 
         ('free',       KEY_UP,   'hotkey'):   (False, None,  'free'),
         ('free',       KEY_DOWN, 'hotkey'):   (False, None,  'free'),
@@ -93,6 +416,10 @@ class _KeyboardListener(_GenericListener):
         ('suppressed', KEY_DOWN, 'hotkey'):   (False, None,  'suppressed'),
         ('allowed',    KEY_UP,   'hotkey'):   (False, None,  'allowed'),
         ('allowed',    KEY_DOWN, 'hotkey'):   (False, None,  'allowed'),
+        ('free',       KEY_HOLD, 'hotkey'):   (False, None,  'free'),
+        ('pending',    KEY_HOLD, 'hotkey'):   (False, None,  'suppressed'),
+        ('suppressed', KEY_HOLD, 'hotkey'):   (False, None,  'suppressed'),
+        ('allowed',    KEY_HOLD, 'hotkey'):   (False, None,  'allowed'),
 
         ('free',       KEY_UP,   'other'):    (False, True,  'free'),
         ('free',       KEY_DOWN, 'other'):    (False, True,  'free'),
@@ -104,6 +431,10 @@ class _KeyboardListener(_GenericListener):
         ('suppressed', KEY_DOWN, 'other'):    (True,  True,  'allowed'),
         ('allowed',    KEY_UP,   'other'):    (False, True,  'allowed'),
         ('allowed',    KEY_DOWN, 'other'):    (False, True,  'allowed'),
+        ('free',       KEY_HOLD, 'other'):    (False, True,  'free'),
+        ('pending',    KEY_HOLD, 'other'):    (True,  True,  'allowed'),
+        ('suppressed', KEY_HOLD, 'other'):    (True,  True,  'allowed'),
+        ('allowed',    KEY_HOLD, 'other'):    (False, True,  'allowed'),
     }
 
     def init(self):
@@ -113,22 +444,36 @@ class _KeyboardListener(_GenericListener):
         self.blocking_hooks = []
         self.blocking_keys = _collections.defaultdict(list)
         self.nonblocking_keys = _collections.defaultdict(list)
-        self.blocking_hotkeys = _collections.defaultdict(list)
-        self.nonblocking_hotkeys = _collections.defaultdict(list)
+        self.blocking_hotkeys = _ChordIndex()
+        self.nonblocking_hotkeys = _ChordIndex()
         self.filtered_modifiers = _collections.Counter()
+        self.blocking_sequences = _Sequences(suppress=True)
+        self.nonblocking_sequences = _Sequences(suppress=False)
         self.is_replaying = False
+        self.pressed = ((), 0)
 
         # Supporting hotkey suppression is harder than it looks. See
         # https://github.com/boppreh/keyboard/issues/22
         self.modifier_states = {} # "alt" -> "allowed"
 
-    def pre_process_event(self, event):
+    def process(self):
+        """
+        Like `GenericListener.process`, but each queued event comes with the
+        mask of keys pressed when it was read, see `direct_callback`.
+        """
+        while True:
+            event, hotkey = self.queue.get()
+            if self.pre_process_event(event, hotkey):
+                self.invoke_handlers(event)
+            self.queue.task_done()
+
+    def pre_process_event(self, event, hotkey):
         for key_hook in self.nonblocking_keys[event.scan_code]:
             key_hook(event)
 
-        with _pressed_events_lock:
-            hotkey = tuple(sorted(_pressed_events))
-        for callback in self.nonblocking_hotkeys[hotkey]:
+        self.nonblocking_sequences.catch_miss(event)
+
+        for callback in self.nonblocking_hotkeys.match(event.scan_code, hotkey):
             callback(event)
 
         return event.scan_code or (event.name and event.name != 'unknown')
@@ -156,6 +501,9 @@ class _KeyboardListener(_GenericListener):
                     # if separate pre-finalized callback is not provided, assume must block
                     return False
 
+        if finalized:
+            self.blocking_sequences.catch_miss(event)
+
         event_type = event.event_type
         scan_code = event.scan_code
 
@@ -165,10 +513,13 @@ class _KeyboardListener(_GenericListener):
                 if event_type == KEY_DOWN:
                     if is_modifier(scan_code): self.active_modifiers.add(scan_code)
                     _pressed_events[scan_code] = event
-                hotkey = tuple(sorted(_pressed_events))
+                    self.pressed = _with_pressed(self.pressed, scan_code, True)
+                # On release the key is still part of the hotkey.
+                hotkey = self.pressed[1]
                 if event_type == KEY_UP:
                     self.active_modifiers.discard(scan_code)
                     if scan_code in _pressed_events: del _pressed_events[scan_code]
+                    self.pressed = _with_pressed(self.pressed, scan_code, False)
 
         # Mappings based on individual keys instead of hotkeys.
         for key_hook in self.blocking_keys[scan_code]:
@@ -184,14 +535,14 @@ class _KeyboardListener(_GenericListener):
         accept = True
 
         if self.blocking_hotkeys and finalized:
-            if self.filtered_modifiers[scan_code]:
+            if self.filtered_modifiers[scan_code] or self.blocking_sequences.filters(scan_code):
                 origin = 'modifier'
                 modifiers_to_update = set([scan_code])
             else:
                 modifiers_to_update = self.active_modifiers
                 if is_modifier(scan_code):
                     modifiers_to_update = modifiers_to_update | {scan_code}
-                callback_results = [callback(event) for callback in self.blocking_hotkeys[hotkey]]
+                callback_results = [callback(event) for callback in self.blocking_hotkeys.match(scan_code, hotkey)]
                 if callback_results:
                     accept = all(callback_results)
                     origin = 'hotkey'
@@ -213,7 +564,7 @@ class _KeyboardListener(_GenericListener):
 
         # Queue for handlers that won't block the event.
         if finalized:
-            self.queue.put(event)
+            self.queue.put((event, hotkey))
 
         return accept
 
@@ -292,6 +643,20 @@ def parse_hotkey(hotkey):
         steps.append(tuple(key_to_scan_codes(key) for key in keys))
     return tuple(steps)
 
+def _output_batch():
+    """
+    Groups the OS events sent in the block into as few writes as possible,
+    where supported (see `_nixkeyboard.batch`).
+    """
+    if hasattr(_os_keyboard, 'batch'):
+        return _os_keyboard.batch()
+    return _nullcontext()
+
+def _output_sync():
+    """ Marks the end of a step inside `_output_batch`. """
+    if hasattr(_os_keyboard, 'sync'):
+        _os_keyboard.sync()
+
 def send(hotkey, do_press=True, do_release=True):
     """
     Sends OS events that perform the given *hotkey* hotkey.
@@ -311,14 +676,17 @@ def send(hotkey, do_press=True, do_release=True):
     _listener.is_replaying = True
 
     parsed = parse_hotkey(hotkey)
-    for step in parsed:
-        if do_press:
-            for scan_codes in step:
-                _os_keyboard.press(scan_codes[0])
-
-        if do_release:
-            for scan_codes in reversed(step):
-                _os_keyboard.release(scan_codes[0])
+    with _output_batch():
+        for step in parsed:
+            if do_press:
+                for scan_codes in step:
+                    _os_keyboard.press(scan_codes[0])
+                _output_sync()
+
+            if do_release:
+                for scan_codes in reversed(step):
+                    _os_keyboard.release(scan_codes[0])
+                _output_sync()
 
     _listener.is_replaying = False
 
@@ -343,31 +711,114 @@ def is_pressed(hotkey):
     """
     _listener.start_if_necessary()
 
+    chord, mask = _listener.pressed
     if _is_number(hotkey):
         # Shortcut.
-        with _pressed_events_lock:
-            return hotkey in _pressed_events
+        return hotkey in chord if hotkey in _other_scan_code_bits else bool(mask & _scan_code_bit(hotkey))
 
     steps = parse_hotkey(hotkey)
     if len(steps) > 1:
         raise ValueError("Impossible to check if multi-step hotkeys are pressed (`a+b` is ok, `a, b` isn't).")
 
-    # Convert _pressed_events into a set
-    with _pressed_events_lock:
-        pressed_scan_codes = set(_pressed_events)
     for scan_codes in steps[0]:
-        if not any(scan_code in pressed_scan_codes for scan_code in scan_codes):
+        if not mask & _chord_mask(scan_codes):
             return False
     return True
 
+def set_key_filter(hotkeys=None):
+    """
+    Restricts the events read from the OS to the keys used by the given
+    hotkeys (names, scan codes or hotkey strings, see `parse_hotkey`), or to
+    all keys if None. Other events are discarded before reaching any hook, by
+    the kernel itself where supported. Currently only has an effect on Linux.
+
+        set_key_filter(['ctrl+shift+m', 115, 114])
+    """
+    if hotkeys is None:
+        scan_codes = None
+    else:
+        scan_codes = set()
+        for hotkey in hotkeys:
+            for step in parse_hotkey(hotkey):
+                for key_scan_codes in step:
+                    scan_codes.update(key_scan_codes)
+    if hasattr(_os_keyboard, 'set_key_filter'):
+        _os_keyboard.set_key_filter(scan_codes)
+
+def device_stats():
+    """
+    Returns counters of the events read from each input device, by path,
+    like `{'/dev/input/event3': {'reads': 12, 'events': 24, 'errors': 0,
+    'debounced': 0}}`. Unplugged devices are kept. Currently only available
+    on Linux, empty elsewhere or before the listener started.
+    """
+    if hasattr(_os_keyboard, 'device_stats'):
+        return _os_keyboard.device_stats()
+    return {}
+
+def set_autorepeat(delay=0.5, interval=0.1):
+    """
+    Generates KEY_HOLD events every `interval` seconds for keys held longer
+    than `delay` on devices that don't autorepeat by themselves, like most
+    gpio buttons, so they behave like keyboards. Devices with kernel
+    autorepeat are left alone. Currently only has an effect on Linux. A
+    `delay` of None disables it.
+    """
+    if hasattr(_os_keyboard, 'set_autorepeat'):
+        _os_keyboard.set_autorepeat(delay, interval, _scheduler)
+
+def set_debounce(window=0.0, keys=None):
+    """
+    Ignores key presses and releases arriving less than `window` seconds
+    after the previous one of the same key on the same device, like the
+    bounce of mechanical buttons, before any hook sees them. The final state
+    of a bouncing key is still reported once the window ends. Currently only
+    has an effect on Linux. A `window` of 0 disables it.
+
+    - `keys` if given, only these keys (names or scan codes) are debounced.
+    It can also be a dict of key -> window, for per key windows.
+
+        set_debounce(0.03)
+        set_debounce(keys={'volume up': 0.05, 248: 0.1})
+    """
+    if keys is None:
+        windows = None
+    else:
+        if not isinstance(keys, dict):
+            keys = dict.fromkeys(keys, window)
+        windows = {}
+        for key, key_window in keys.items():
+            for scan_code in key_to_scan_codes(key):
+                windows[scan_code] = key_window
+    if hasattr(_os_keyboard, 'set_debounce'):
+        _os_keyboard.set_debounce(window, windows)
+
+def close_output():
+    """
+    Destroys the virtual keyboard used to send events, if one was created.
+    It's created again if more events are sent. Currently only used on Linux.
+    """
+    if hasattr(_os_keyboard, 'close_output'):
+        _os_keyboard.close_output()
+
 def call_later(fn, args=(), delay=0.001):
     """
-    Calls the provided function in a new thread after waiting some time.
-    Useful for giving the system some time to process an event, without blocking
-    the current execution flow.
+    Calls the provided function in the scheduler thread after waiting some
+    time. Useful for giving the system some time to process an event, without
+    blocking the current execution flow. Calls are made in order, so they
+    should not block for long.
+
+    Returns a handle whose `cancel()` method prevents the call if it didn't
+    happen yet.
     """
-    thread = _Thread(target=lambda: (_time.sleep(delay), fn(*args)))
-    thread.start()
+    return _scheduler.call_later(delay, fn, args)
+
+def get_scheduler():
+    """
+    Returns the scheduler running `call_later` calls and hotkey timeouts, to
+    share its thread and clock. See `_scheduler.Scheduler`.
+    """
+    return _scheduler
 
 _hooks = {}
 def hook(callback, suppress=False, on_remove=lambda: None):
@@ -403,7 +854,8 @@ def hook(callback, suppress=False, on_remove=lambda: None):
 
 def on_press(callback, suppress=False):
     """
-    Invokes `callback` for every KEY_DOWN event. For details see `hook`.
+    Invokes `callback` for every KEY_DOWN event, and its KEY_HOLD autorepeats.
+    For details see `hook`.
     """
     return hook(lambda e: e.event_type == KEY_UP or callback(e), suppress=suppress)
 
@@ -411,7 +863,7 @@ def on_release(callback, suppress=False):
     """
     Invokes `callback` for every KEY_UP event. For details see `hook`.
     """
-    return hook(lambda e: e.event_type == KEY_DOWN or callback(e), suppress=suppress)
+    return hook(lambda e: e.event_type != KEY_UP or callback(e), suppress=suppress)
 
 def hook_key(key, callback, suppress=False):
     """
@@ -439,7 +891,8 @@ def hook_key(key, callback, suppress=False):
 
 def on_press_key(key, callback, suppress=False):
     """
-    Invokes `callback` for KEY_DOWN event related to the given key. For details see `hook`.
+    Invokes `callback` for KEY_DOWN and KEY_HOLD events related to the given
+    key. For details see `hook`.
     """
     return hook_key(key, lambda e: e.event_type == KEY_UP or callback(e), suppress=suppress)
 
@@ -447,7 +900,7 @@ def on_release_key(key, callback, suppress=False):
     """
     Invokes `callback` for KEY_UP event related to the given key. For details see `hook`.
     """
-    return hook_key(key, lambda e: e.event_type == KEY_DOWN or callback(e), suppress=suppress)
+    return hook_key(key, lambda e: e.event_type != KEY_UP or callback(e), suppress=suppress)
 
 def unhook(remove):
     """
@@ -482,10 +935,10 @@ def remap_key(src, dst):
     press or release the hotkey `dst` instead.
     """
     def handler(event):
-        if event.event_type == KEY_DOWN:
-            press(dst)
-        else:
+        if event.event_type == KEY_UP:
             release(dst)
+        else:
+            press(dst)
         return False
     return hook_key(src, handler, suppress=True)
 unremap_key = unhook_key
@@ -495,42 +948,38 @@ def parse_hotkey_combinations(hotkey):
     Parses a user-provided hotkey. Differently from `parse_hotkey`,
     instead of each step being a list of the different scan codes for each key,
     each step is a list of all possible combinations of those scan codes.
+
+    Note: the number of combinations grows exponentially with the number of
+    keys with alternative scan codes. Hotkeys are matched from `parse_hotkey`
+    steps instead, this is only kept for compatibility.
     """
     def combine_step(step):
-        # A single step may be composed of many keys, and each key can have
-        # multiple scan codes. To speed up hotkey matching and avoid introducing
-        # event delays, we list all possible combinations of scan codes for these
-        # keys. Hotkeys are usually small, and there are not many combinations, so
-        # this is not as insane as it sounds.
         return (tuple(sorted(scan_codes)) for scan_codes in _itertools.product(*step))
 
     return tuple(tuple(combine_step(step)) for step in parse_hotkey(hotkey))
 
-def _add_hotkey_step(handler, combinations, suppress):
+def _add_hotkey_step(handler, step, suppress, exact=True):
     """
-    Hooks a single-step hotkey (e.g. 'shift+a').
+    Hooks a single-step hotkey (e.g. 'shift+a'), given as a step from
+    `parse_hotkey`.
     """
     container = _listener.blocking_hotkeys if suppress else _listener.nonblocking_hotkeys
 
-    # Register the scan codes of every possible combination of
-    # modfiier + main key. Modifiers have to be registered in
-    # filtered_modifiers too, so suppression and replaying can work.
-    for scan_codes in combinations:
-        for scan_code in scan_codes:
-            if is_modifier(scan_code):
-                _listener.filtered_modifiers[scan_code] += 1
-        container[scan_codes].append(handler)
+    # Modifiers have to be registered in filtered_modifiers too, so
+    # suppression and replaying can work.
+    modifiers = [scan_code for scan_codes in step for scan_code in scan_codes if is_modifier(scan_code)]
+    for scan_code in modifiers:
+        _listener.filtered_modifiers[scan_code] += 1
+    container.add(step, handler, exact)
 
     def remove():
-        for scan_codes in combinations:
-            for scan_code in scan_codes:
-                if is_modifier(scan_code):
-                    _listener.filtered_modifiers[scan_code] -= 1
-            container[scan_codes].remove(handler)
+        for scan_code in modifiers:
+            _listener.filtered_modifiers[scan_code] -= 1
+        container.remove(step, handler)
     return remove
 
 _hotkeys = {}
-def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_release=False):
+def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_release=False, exact=True, trigger_on_hold=False, pass_event=False):
     """
     Invokes a callback every time a hotkey is pressed. The hotkey must
     be in the format `ctrl+shift+a, s`. This would trigger when the user holds
@@ -545,6 +994,12 @@ def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_
     - `timeout` is the amount of seconds allowed to pass between key presses.
     - `trigger_on_release` if true, the callback is invoked on key release instead
     of key press.
+    - `exact` if false, the hotkey also triggers while other keys are held
+    (e.g. a stuck key), not only when its keys are the only ones pressed.
+    - `trigger_on_hold` if true, the callback is invoked on every autorepeat
+    (KEY_HOLD event) of the hotkey's last key instead of key press.
+    - `pass_event` if true, the KeyboardEvent that triggered the hotkey is
+    passed to the callback after `args`.
 
     The event handler function is returned. To remove a hotkey call
     `remove_hotkey(hotkey)` or `remove_hotkey(handler)`.
@@ -567,21 +1022,29 @@ def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_
         add_hotkey('ctrl+q', quit)
         add_hotkey('ctrl+alt+enter, space', some_callback)
     """
+    if pass_event:
+        invoke = lambda e, callback=callback: callback(*args, e)
     if args:
         callback = lambda callback=callback: callback(*args)
+    if not pass_event:
+        invoke = lambda e: callback()
 
     _listener.start_if_necessary()
 
-    steps = parse_hotkey_combinations(hotkey)
+    steps = parse_hotkey(hotkey)
+    if hasattr(_os_keyboard, 'add_output_codes'):
+        # Suppressed keys are replayed through the virtual keyboard, enable
+        # them before it is created.
+        _os_keyboard.add_output_codes(scan_code for step in steps for key in step for scan_code in key)
 
-    event_type = KEY_UP if trigger_on_release else KEY_DOWN
+    event_type = KEY_UP if trigger_on_release else KEY_HOLD if trigger_on_hold else KEY_DOWN
     if len(steps) == 1:
         # Deciding when to allow a KEY_UP event is far harder than I thought,
         # and any mistake will make that key "sticky". Therefore just let all
         # KEY_UP events go through as long as that's not what we are listening
         # for.
-        handler = lambda e: (event_type == KEY_DOWN and e.event_type == KEY_UP and e.scan_code in _logically_pressed_keys) or (event_type == e.event_type and callback())
-        remove_step = _add_hotkey_step(handler, steps[0], suppress)
+        handler = lambda e: (event_type != KEY_UP and e.event_type == KEY_UP and e.scan_code in _logically_pressed_keys) or (event_type == e.event_type and invoke(e))
+        remove_step = _add_hotkey_step(handler, steps[0], suppress, exact)
         def remove_():
             remove_step()
             _hotkeys.pop(hotkey, None)
@@ -592,82 +1055,11 @@ def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_
         _hotkeys[hotkey] = _hotkeys[remove_] = _hotkeys[callback] = remove_
         return remove_
 
-    state = _State()
-    state.remove_catch_misses = lambda: None
-    state.remove_last_step = None
-    state.suppressed_events = []
-    state.last_update = float('-inf')
-
-    def catch_misses(event, force_fail=False):
-        if (
-                event.event_type == event_type
-                and state.index
-                and event.scan_code not in allowed_keys_by_step[state.index]
-            ) or (
-                timeout
-                and _time.monotonic() - state.last_update >= timeout
-            ) or force_fail: # Weird formatting to ensure short-circuit.
-
-            state.remove_last_step()
-
-            for event in state.suppressed_events:
-                if event.event_type == KEY_DOWN:
-                    press(event.scan_code)
-                else:
-                    release(event.scan_code)
-            del state.suppressed_events[:]
-
-            index = 0
-            set_index(0)
-        return True
-
-    def set_index(new_index):
-        state.index = new_index
-
-        if new_index == 0:
-            # This is done for performance reasons, avoiding a global key hook
-            # that is always on.
-            state.remove_catch_misses()
-            state.remove_catch_misses = lambda: None
-        elif new_index == 1:
-            state.remove_catch_misses()
-            # Must be `suppress=True` to ensure `send` has priority.
-            state.remove_catch_misses = hook(catch_misses, suppress=True)
-
-        if new_index == len(steps) - 1:
-            def handler(event):
-                if event.event_type == KEY_UP:
-                    remove()
-                    set_index(0)
-                accept = event.event_type == event_type and callback()
-                if accept:
-                    return catch_misses(event, force_fail=True)
-                else:
-                    state.suppressed_events[:] = [event]
-                    return False
-            remove = _add_hotkey_step(handler, steps[state.index], suppress)
-        else:
-            # Fix value of next_index.
-            def handler(event, new_index=state.index+1):
-                if event.event_type == KEY_UP:
-                    remove()
-                    set_index(new_index)
-                state.suppressed_events.append(event)
-                return False
-            remove = _add_hotkey_step(handler, steps[state.index], suppress)
-        state.remove_last_step = remove
-        state.last_update = _time.monotonic()
-        return False
-    set_index(0)
-
-    allowed_keys_by_step = [
-        set().union(*step)
-        for step in steps
-    ]
+    sequences = _listener.blocking_sequences if suppress else _listener.nonblocking_sequences
+    remove_sequence = sequences.add(steps, invoke, event_type, timeout, exact)
 
     def remove_():
-        state.remove_catch_misses()
-        state.remove_last_step()
+        remove_sequence()
         _hotkeys.pop(hotkey, None)
         _hotkeys.pop(remove_, None)
         _hotkeys.pop(callback, None)
@@ -694,6 +1086,8 @@ def unhook_all_hotkeys():
     # are removed together.
     _listener.blocking_hotkeys.clear()
     _listener.nonblocking_hotkeys.clear()
+    _listener.blocking_sequences.clear()
+    _listener.nonblocking_sequences.clear()
 unregister_all_hotkeys = remove_all_hotkeys = clear_all_hotkeys = unhook_all_hotkeys
 
 def remap_hotkey(src, dst, suppress=True, trigger_on_release=False):
@@ -724,8 +1118,9 @@ def stash_state():
     # TODO: stash caps lock / numlock /scrollock state.
     with _pressed_events_lock:
         state = sorted(_pressed_events)
-    for scan_code in state:
-        _os_keyboard.release(scan_code)
+    with _output_batch():
+        for scan_code in state:
+            _os_keyboard.release(scan_code)
     return state
 
 def restore_state(scan_codes):
@@ -738,10 +1133,12 @@ def restore_state(scan_codes):
     with _pressed_events_lock:
         current = set(_pressed_events)
     target = set(scan_codes)
-    for scan_code in current - target:
-        _os_keyboard.release(scan_code)
-    for scan_code in target - current:
-        _os_keyboard.press(scan_code)
+    with _output_batch():
+        for scan_code in current - target:
+            _os_keyboard.release(scan_code)
+        _output_sync()
+        for scan_code in target - current:
+            _os_keyboard.press(scan_code)
 
     _listener.is_replaying = False
 
@@ -880,6 +1277,98 @@ def read_event(suppress=False):
         unhook(hooked)
         return event
 
+class _Subscription(object):
+    """
+    Long lived stream of keyboard events, see `subscribe`.
+    """
+    overflow_policies = ('drop_oldest', 'drop_newest')
+
+    def __init__(self, maxsize=0, overflow_policy='drop_oldest'):
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError('Unknown overflow policy {}, expected one of {}'.format(repr(overflow_policy), self.overflow_policies))
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.closed = False
+        self._events = _collections.deque()
+        self._not_empty = _Condition(_Lock())
+        self._remove = hook(self._put)
+
+    def _put(self, event):
+        with self._not_empty:
+            if self.maxsize and len(self._events) >= self.maxsize:
+                self.dropped += 1
+                if self.overflow_policy == 'drop_newest':
+                    return
+                self._events.popleft()
+            self._events.append(event)
+            self._not_empty.notify()
+
+    def __len__(self):
+        return len(self._events)
+
+    def get(self, timeout=None):
+        """
+        Returns the next event, blocking for at most `timeout` seconds (forever
+        if None). Returns None if the timeout expires or the subscription is
+        closed.
+        """
+        with self._not_empty:
+            if timeout is None:
+                while not self._events and not self.closed:
+                    self._not_empty.wait()
+            elif not self._events and not self.closed:
+                deadline = _time.monotonic() + timeout
+                while not self._events and not self.closed:
+                    remaining = deadline - _time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._not_empty.wait(remaining)
+            if self._events:
+                return self._events.popleft()
+            return None
+
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        """ Stops receiving events and wakes up any blocked `get`. """
+        with self._not_empty:
+            if self.closed:
+                return
+            self.closed = True
+            self._not_empty.notify_all()
+        self._remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def subscribe(maxsize=0, overflow_policy='drop_oldest'):
+    """
+    Hooks a persistent queue to the keyboard events and returns it. Unlike
+    calling `read_event` in a loop no events are lost between reads.
+
+    - `maxsize` is the maximum number of buffered events, 0 means unbounded.
+    - `overflow_policy` is 'drop_oldest' or 'drop_newest', deciding which event
+    is discarded when the buffer is full. Discarded events are counted in the
+    `dropped` attribute.
+
+    The returned object has a `get(timeout=None)` method, can be iterated, and
+    should be closed (or used as a context manager) when no longer needed.
+
+        with subscribe(maxsize=100) as events:
+            for event in events:
+                print(event)
+    """
+    return _Subscription(maxsize, overflow_policy)
+
 def read_key(suppress=False):
     """
     Blocks until a keyboard event happens, then returns that event's name or,
@@ -900,7 +1389,7 @@ def read_hotkey(suppress=True):
         # "ctrl+shift+p"
     """
     queue = _queue.Queue()
-    fn = lambda e: queue.put(e) or e.event_type == KEY_DOWN
+    fn = lambda e: queue.put(e) or e.event_type != KEY_UP
     hooked = hook(fn, suppress=suppress)
     while True:
         event = queue.get()
@@ -940,13 +1429,15 @@ def get_typed_strings(events, allow_backspace=True):
         if event.name == 'space':
             name = ' '
 
+        # Held keys repeat like presses, a held shift is still pressed.
+        pressed = event.event_type != KEY_UP
         if 'shift' in event.name:
-            shift_pressed = event.event_type == 'down'
-        elif event.name == 'caps lock' and event.event_type == 'down':
+            shift_pressed = pressed
+        elif event.name == 'caps lock' and event.event_type == KEY_DOWN:
             capslock_pressed = not capslock_pressed
-        elif allow_backspace and event.name == backspace_name and event.event_type == 'down':
+        elif allow_backspace and event.name == backspace_name and pressed:
             string = string[:-1]
-        elif event.event_type == 'down':
+        elif pressed:
             if len(name) == 1:
                 if shift_pressed ^ capslock_pressed:
                     name = name.upper()
@@ -995,6 +1486,24 @@ def record(until='escape', suppress=False, trigger_on_release=False):
     wait(until, suppress=suppress, trigger_on_release=trigger_on_release)
     return stop_recording()
 
+def _delayed_groups(events, speed_factor):
+    """
+    Splits recorded events into lists without a delay between their events,
+    yielding (seconds to wait before the list, list).
+    """
+    group = []
+    delay = 0
+    last_time = None
+    for event in events:
+        if speed_factor > 0 and last_time is not None and event.time > last_time:
+            yield delay, group
+            group = []
+            delay = (event.time - last_time) / speed_factor
+        last_time = event.time
+        group.append(event)
+    if group:
+        yield delay, group
+
 def play(events, speed_factor=1.0):
     """
     Plays a sequence of recorded events, maintaining the relative time
@@ -1006,19 +1515,19 @@ def play(events, speed_factor=1.0):
     """
     state = stash_state()
 
-    last_time = None
-    for event in events:
-        if speed_factor > 0 and last_time is not None:
-            _time.sleep((event.time - last_time) / speed_factor)
-        last_time = event.time
-
-        key = event.scan_code or event.name
-        if (key == 91) and event.event_type == KEY_DOWN:
-            press("left windows")
-        elif (key == 91) and event.event_type == KEY_UP:
-            release("left windows")
-        else:
-            press(key) if event.event_type == KEY_DOWN else release(key)
+    for delay, group in _delayed_groups(events, speed_factor):
+        if delay:
+            _time.sleep(delay)
+        # Events without a delay between them are written together.
+        with _output_batch():
+            for event in group:
+                key = event.scan_code or event.name
+                if (key == 91) and event.event_type != KEY_UP:
+                    press("left windows")
+                elif (key == 91) and event.event_type == KEY_UP:
+                    release("left windows")
+                else:
+                    release(key) if event.event_type == KEY_UP else press(key)
 
     restore_modifiers(state)
 replay = play
@@ -1,25 +1,33 @@
 # -*- coding: utf-8 -*-
-from time import time as now
+from time import monotonic_ns
 import json
 
 from ._canonical_names import normalize_name
 
 KEY_DOWN = 'down'
 KEY_UP = 'up'
+# Autorepeat of a key that is held down, after its KEY_DOWN.
+KEY_HOLD = 'hold'
 
 class KeyboardEvent(object):
     event_type = None
     scan_code = None
     name = None
     time = None
+    time_ns = None
     device = None
     modifiers = None
     is_keypad = None
 
-    def __init__(self, event_type, scan_code, name=None, time=None, device=None, modifiers=None, is_keypad=None):
+    def __init__(self, event_type, scan_code, name=None, time=None, device=None, modifiers=None, is_keypad=None, time_ns=None):
         self.event_type = event_type
         self.scan_code = scan_code
-        self.time = now() if time is None else time
+        # Both are monotonic clock readings unless given otherwise, `time` in
+        # float seconds and `time_ns` in integer nanoseconds.
+        if time_ns is None:
+            time_ns = monotonic_ns() if time is None else int(time * 1e9)
+        self.time_ns = time_ns
+        self.time = time_ns / 1e9 if time is None else time
         self.device = device
         self.is_keypad = is_keypad
         self.modifiers = modifiers
@@ -28,7 +36,7 @@ class KeyboardEvent(object):
 
     def to_json(self, ensure_ascii=False):
         attrs = dict(
-            (attr, getattr(self, attr)) for attr in ['event_type', 'scan_code', 'name', 'time', 'device', 'is_keypad', 'modifiers']
+            (attr, getattr(self, attr)) for attr in ['event_type', 'scan_code', 'name', 'time', 'time_ns', 'device', 'is_keypad', 'modifiers']
             if not attr.startswith('_')
         )
         return json.dumps(attrs, ensure_ascii=ensure_ascii)
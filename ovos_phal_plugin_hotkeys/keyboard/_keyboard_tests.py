@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import unittest
 import time
+from unittest.mock import Mock, patch
 
 import keyboard
-from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP
+from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP, KEY_HOLD
 
 """
 Side effects are avoided using two techniques:
@@ -72,6 +73,7 @@ keyboard._os_keyboard.type_unicode = lambda char: output_events.append(KeyboardE
 d_a = [make_event(KEY_DOWN, 'a')]
 u_a = [make_event(KEY_UP, 'a')]
 du_a = d_a+u_a
+h_a = [make_event(KEY_HOLD, 'a')]
 d_b = [make_event(KEY_DOWN, 'b')]
 u_b = [make_event(KEY_UP, 'b')]
 du_b = d_b+u_b
@@ -84,6 +86,7 @@ du_ctrl = d_ctrl+u_ctrl
 d_shift = [make_event(KEY_DOWN, 'left shift')]
 u_shift = [make_event(KEY_UP, 'left shift')]
 du_shift = d_shift+u_shift
+h_shift = [make_event(KEY_HOLD, 'left shift')]
 d_alt = [make_event(KEY_DOWN, 'alt')]
 u_alt = [make_event(KEY_UP, 'alt')]
 du_alt = d_alt+u_alt
@@ -122,7 +125,7 @@ class TestKeyboard(unittest.TestCase):
             if keyboard._listener.direct_callback(event):
                 output_events.append(event)
         if expected is not None:
-            to_names = lambda es: '+'.join(('d' if e.event_type == KEY_DOWN else 'u') + '_' + str(e.scan_code) for e in es)
+            to_names = lambda es: '+'.join({KEY_DOWN: 'd', KEY_HOLD: 'h', KEY_UP: 'u'}[e.event_type] + '_' + str(e.scan_code) for e in es)
             self.assertEqual(to_names(output_events), to_names(expected))
         del output_events[:]
 
@@ -235,6 +238,17 @@ class TestKeyboard(unittest.TestCase):
         self.do(u_a+d_a)
         with self.assertRaises(ValueError):
             keyboard.is_pressed('a, b')
+    def test_pressed_chord_and_mask(self):
+        self.do(d_b+d_a)
+        self.assertEqual(keyboard._listener.pressed, ((1, 2), keyboard._chord_mask((1, 2))))
+        self.do(u_b+d_a)
+        self.assertEqual(keyboard._listener.pressed, ((1,), keyboard._chord_mask((1,))))
+        self.do(u_a)
+        self.assertEqual(keyboard._listener.pressed, ((), 0))
+    def test_scan_code_bits_unique(self):
+        bits = [keyboard._scan_code_bit(scan_code) for scan_code in (0, 1, 2, -1, -2, 'x')]
+        self.assertEqual(len(set(bits)), len(bits))
+        self.assertEqual(keyboard._scan_code_bit(-1), keyboard._scan_code_bit(-1))
 
     def test_send_single_press_release(self):
         keyboard.send('a', do_press=True, do_release=True)
@@ -319,6 +333,9 @@ class TestKeyboard(unittest.TestCase):
     def test_on_release(self):
         keyboard.on_release(lambda e: self.assertEqual(e.name, 'a') and self.assertEqual(e.event_type, KEY_UP))
         self.do(d_a+u_a)
+    def test_on_release_ignores_hold(self):
+        keyboard.on_release(lambda e: e.event_type == KEY_UP and False, suppress=True)
+        self.do(d_a+h_a+u_a, d_a+h_a)
 
     def test_hook_key_invalid(self):
         with self.assertRaises(ValueError):
@@ -465,6 +482,12 @@ class TestKeyboard(unittest.TestCase):
         keyboard.play(events, 1)
         self.do([], d_a+u_a)
         self.assertGreater(time.time() - last_time, 0.005)
+    def test_play_groups(self):
+        events = [make_event(KEY_DOWN, 'a', 1, 100), make_event(KEY_UP, 'a', 1, 100), make_event(KEY_DOWN, 'b', 2, 100.5)]
+        groups = list(keyboard._delayed_groups(events, 2))
+        self.assertEqual(groups, [(0, events[:2]), (0.25, events[2:])])
+        self.assertEqual(list(keyboard._delayed_groups(events, 0)), [(0, events)])
+        self.assertEqual(list(keyboard._delayed_groups([], 1)), [])
 
     def test_get_typed_strings_simple(self):
         events = du_a+du_b+du_backspace+d_shift+du_a+u_shift+du_space+du_ctrl+du_a
@@ -480,6 +503,11 @@ class TestKeyboard(unittest.TestCase):
     def test_get_typed_strings_all(self):
         events = du_a+du_b+du_backspace+d_shift+du_a+du_capslock+du_b+u_shift+du_space+du_ctrl+du_a
         self.assertEqual(list(keyboard.get_typed_strings(events)), ['aAb ', 'A'])
+    def test_get_typed_strings_hold(self):
+        events = d_a+h_a+h_a+u_a
+        self.assertEqual(list(keyboard.get_typed_strings(events)), ['aaa'])
+        events = d_shift+h_shift+h_shift+du_a+u_shift+du_b
+        self.assertEqual(list(keyboard.get_typed_strings(events)), ['Ab'])
 
     def test_get_hotkey_name_simple(self):
         self.assertEqual(keyboard.get_hotkey_name(['a']), 'a')
@@ -510,6 +538,17 @@ class TestKeyboard(unittest.TestCase):
         time.sleep(0.01)
         self.do(d_ctrl+d_a+d_b+u_ctrl)
         self.assertEqual(queue.get(timeout=0.5), 'ctrl+a+b')
+    def test_read_hotkey_hold(self):
+        queue = keyboard._queue.Queue()
+        def process():
+            queue.put(keyboard.read_hotkey())
+        from threading import Thread
+        t = Thread(target=process)
+        t.daemon = True
+        t.start()
+        time.sleep(0.01)
+        self.do(d_shift+h_shift+h_shift+d_a+h_a+u_a, d_shift+h_shift+h_shift+d_a+h_a)
+        self.assertEqual(queue.get(timeout=0.5), 'shift+a')
 
     def test_read_event(self):
         queue = keyboard._queue.Queue()
@@ -523,6 +562,54 @@ class TestKeyboard(unittest.TestCase):
         self.do(d_a, [])
         self.assertEqual(queue.get(timeout=0.5), d_a[0])
 
+    def test_subscribe(self):
+        with keyboard.subscribe() as events:
+            self.do(du_a+d_b)
+            self.assertEqual(events.get(timeout=0.5), d_a[0])
+            self.assertEqual(events.get(timeout=0.5), u_a[0])
+            self.assertEqual(events.get(timeout=0.5), d_b[0])
+            self.assertIsNone(events.get(timeout=0.01))
+        self.assertTrue(events.closed)
+    def test_subscribe_drop_oldest(self):
+        with keyboard.subscribe(maxsize=2) as events:
+            self.do(du_a+d_b)
+            self.assertEqual(events.dropped, 1)
+            self.assertEqual(list(events._events), u_a+d_b)
+    def test_subscribe_drop_newest(self):
+        with keyboard.subscribe(maxsize=2, overflow_policy='drop_newest') as events:
+            self.do(du_a+d_b)
+            self.assertEqual(events.dropped, 1)
+            self.assertEqual(list(events._events), du_a)
+    def test_subscribe_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            keyboard.subscribe(overflow_policy='block')
+
+    def test_call_later(self):
+        queue = keyboard._queue.Queue()
+        keyboard.call_later(queue.put, args=(1,), delay=0.02)
+        keyboard.call_later(queue.put, args=(2,), delay=0.01)
+        keyboard.call_later(queue.put, args=(3,), delay=0.01).cancel()
+        self.assertEqual(queue.get(timeout=0.5), 2)
+        self.assertEqual(queue.get(timeout=0.5), 1)
+        self.assertTrue(queue.empty())
+
+    def test_scheduler_fake_clock(self):
+        from keyboard._scheduler import Scheduler
+        now = [0]
+        scheduler = Scheduler(clock=lambda: now[0], threaded=False)
+        calls = []
+        scheduler.call_later(2, calls.append, ('b',))
+        scheduler.call_later(1, calls.append, ('a',))
+        cancelled = scheduler.call_later(1, calls.append, ('c',))
+        cancelled.cancel()
+        self.assertEqual(scheduler.run_due(), 0)
+        now[0] = 1
+        self.assertEqual(scheduler.run_due(), 1)
+        now[0] = 5
+        self.assertEqual(scheduler.run_due(), 1)
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual(len(scheduler), 0)
+
     def test_read_key(self):
         queue = keyboard._queue.Queue()
         def process():
@@ -689,6 +776,45 @@ class TestKeyboard(unittest.TestCase):
         keyboard.add_hotkey('ctrl+shift+a', lambda: queue.put(True), suppress=False)
         self.do(d_shift+d_ctrl+d_a)
         self.assertTrue(queue.get(timeout=0.5))
+    def test_add_hotkey_single_step_nonsuppress_release_with_modifier(self):
+        queue = keyboard._queue.Queue()
+        keyboard.add_hotkey('shift+a', lambda: queue.put(True), suppress=False, trigger_on_release=True)
+        self.do(d_shift+du_a+u_shift)
+        self.assertTrue(queue.get(timeout=0.5))
+    def test_add_hotkey_single_step_exact_other_key_held(self):
+        keyboard.add_hotkey('shift+a', trigger, suppress=True)
+        self.do(d_c+d_shift+d_a, d_c+d_shift+d_a)
+    def test_add_hotkey_single_step_subset_other_key_held(self):
+        keyboard.add_hotkey('shift+a', trigger, suppress=True, exact=False)
+        self.do(d_c+d_shift+d_a, d_c+triggered_event)
+    def test_add_hotkey_single_step_one_chord_per_step(self):
+        keyboard.add_hotkey('shift+ctrl+a', trigger, suppress=True)
+        self.assertEqual(keyboard._listener.blocking_hotkeys.values(), [[keyboard._listener.blocking_hotkeys[((1,), (5, 6), (7,))][0]]])
+        self.assertEqual(keyboard._listener.filtered_modifiers, {5: 1, 6: 1, 7: 1})
+    def test_add_hotkey_single_step_suppress_right_modifier(self):
+        keyboard.add_hotkey('shift+a', trigger, suppress=True)
+        self.do([make_event(KEY_DOWN, 'right shift')]+d_a, triggered_event)
+    def test_add_hotkey_single_step_suppress_hold(self):
+        keyboard.add_hotkey('a', trigger, suppress=True)
+        self.do(d_a+h_a+h_a+u_a, triggered_event)
+    def test_add_hotkey_single_step_trigger_on_hold(self):
+        keyboard.add_hotkey('shift+a', trigger, suppress=True, trigger_on_hold=True)
+        self.do(d_shift+d_a+h_a+h_a, triggered_event+triggered_event)
+    def test_add_hotkey_single_step_suppress_held_modifier(self):
+        keyboard.add_hotkey('shift+a', trigger, suppress=True)
+        self.do(d_shift+h_shift+h_shift+d_a, triggered_event)
+    def test_add_hotkey_single_step_pass_event(self):
+        queue = keyboard._queue.Queue()
+        keyboard.add_hotkey('shift+a', lambda *args: queue.put(args), args=('x',), pass_event=True)
+        self.do(d_shift+d_a)
+        arg, event = queue.get(timeout=0.5)
+        self.assertEqual(arg, 'x')
+        self.assertEqual((event.event_type, event.scan_code), (KEY_DOWN, 1))
+    def test_add_hotkey_multi_step_pass_event(self):
+        events = []
+        keyboard.add_hotkey('a, b', lambda event: events.append(event), suppress=True, pass_event=True)
+        self.do(du_a+d_b, [])
+        self.assertEqual([(e.event_type, e.scan_code) for e in events], [(KEY_DOWN, 2)])
     def test_add_hotkey_single_step_suppress_regression_1(self):
         keyboard.add_hotkey('a', trigger, suppress=True)
         self.do(d_c+d_a+u_c+u_a, d_c+d_a+u_c+u_a)
@@ -757,14 +883,47 @@ class TestKeyboard(unittest.TestCase):
     def test_add_hotkey_multistep_suppress_repeated_key(self):
         keyboard.add_hotkey('a, b', trigger, suppress=True)
         self.do(du_a+du_a+du_b, du_a+triggered_event)
-        self.assertEqual(keyboard._listener.blocking_hotkeys[(2,)], [])
+        # Back at the root, the second step is registered but doesn't match.
+        self.assertEqual(keyboard._listener.blocking_hotkeys.match(2, keyboard._chord_mask([2])), [])
         self.assertEqual(len(keyboard._listener.blocking_hotkeys[(1,)]), 1)
+    def test_add_hotkey_multistep_registered_once(self):
+        keyboard.add_hotkey('shift+a, ctrl+b, c', trigger, suppress=True)
+        handlers = keyboard._listener.blocking_hotkeys.values()
+        self.assertEqual(len(handlers), 3)
+        self.do(d_shift+du_a+u_shift+d_ctrl+du_b+u_ctrl+du_c, triggered_event)
+        # Not a step at the root.
+        self.do(du_c, du_c)
+        self.assertEqual(keyboard._listener.blocking_hotkeys.values(), handlers)
+        self.assertFalse(any(keyboard._listener.filtered_modifiers.values()))
     def test_add_hotkey_multi_step_suppress_regression_1(self):
         keyboard.add_hotkey('a, b', trigger, suppress=True)
         self.do(d_c+d_a+u_c+u_a+du_c, d_c+d_a+u_c+u_a+du_c)
     def test_add_hotkey_multi_step_suppress_replays(self):
         keyboard.add_hotkey('a, b, c', trigger, suppress=True)
         self.do(du_a+du_b+du_a+du_b+du_space, du_a+du_b+du_a+du_b+du_space)
+    def test_add_hotkey_multi_step_suppress_shared_prefix(self):
+        keyboard.add_hotkey('a, b', trigger, suppress=True)
+        keyboard.add_hotkey('a, c', lambda: keyboard.press(998), suppress=True)
+        self.assertEqual(len(keyboard._listener.blocking_hotkeys[(1,)]), 1)
+        self.do(du_a+du_c, [KeyboardEvent(KEY_DOWN, scan_code=998)])
+        self.do(du_a+du_b, triggered_event)
+        self.do(du_a+du_space, du_a+du_space)
+    def test_add_hotkey_multi_step_suppress_remove_one(self):
+        keyboard.add_hotkey('a, b', trigger, suppress=True)
+        remove = keyboard.add_hotkey('a, c', trigger, suppress=True)
+        remove()
+        self.do(du_a+du_c, du_a+du_c)
+        self.do(du_a+du_b, triggered_event)
+    def test_add_hotkey_multi_step_timeout_replays_without_event(self):
+        keyboard.add_hotkey('a, b', trigger, timeout=0.01, suppress=True)
+        self.do(du_a, [])
+        time.sleep(0.05)
+        self.assertEqual(output_events, du_a)
+    def test_add_hotkey_multi_step_nonsuppress(self):
+        queue = keyboard._queue.Queue()
+        keyboard.add_hotkey('a, b', lambda: queue.put(True), suppress=False)
+        self.do(du_a+du_b, du_a+du_b)
+        self.assertTrue(queue.get(timeout=0.5))
 
     def test_add_word_listener_success(self):
         queue = keyboard._queue.Queue()
@@ -821,6 +980,50 @@ class TestKeyboard(unittest.TestCase):
     #    keyboard.add_abbreviation('abc', 'aaa')
     #    self.do(du_a+du_b+du_c+du_space, [])
 
+@unittest.skipUnless(hasattr(keyboard._os_keyboard, 'batch'), 'no batched output on this platform')
+class TestOutputBatch(unittest.TestCase):
+    """
+    The OS functions write to a mocked device instead of going through the
+    listener like in `TestKeyboard`, to see the batches they make.
+    """
+    def setUp(self):
+        os_keyboard = keyboard._os_keyboard
+        self.device = Mock()
+        for name, value in [('device', self.device), ('build_device', lambda: None),
+                            ('press', lambda scan_code: os_keyboard.write_event(scan_code, True)),
+                            ('release', lambda scan_code: os_keyboard.write_event(scan_code, False))]:
+            patcher = patch.object(os_keyboard, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(keyboard._pressed_events.clear)
+
+    def frames(self, *frames):
+        EV_KEY = keyboard._os_keyboard.EV_KEY
+        return [[(EV_KEY, scan_code, value) for scan_code, value in frame] for frame in frames]
+
+    def test_send(self):
+        keyboard.send('left ctrl+alt+backspace')
+        self.device.write_events.assert_called_once_with(self.frames([(7, 1), (4, 1), (8, 1)], [(8, 0), (4, 0), (7, 0)]))
+        self.device.write_event.assert_not_called()
+
+    def test_send_steps(self):
+        keyboard.send('alt+a, b')
+        self.device.write_events.assert_called_once_with(self.frames([(4, 1), (1, 1)], [(1, 0), (4, 0)], [(2, 1)], [(2, 0)]))
+
+    def test_press(self):
+        keyboard.press('left ctrl+alt+backspace')
+        self.device.write_events.assert_called_once_with(self.frames([(7, 1), (4, 1), (8, 1)]))
+
+    def test_release(self):
+        keyboard.release('left ctrl+alt+backspace')
+        self.device.write_events.assert_called_once_with(self.frames([(8, 0), (4, 0), (7, 0)]))
+
+    def test_restore_state(self):
+        keyboard._pressed_events.update({7: d_ctrl[0], 4: d_alt[0]})
+        keyboard.restore_state([4, 8])
+        # Releases first, so the keys are never all down at once.
+        self.device.write_events.assert_called_once_with(self.frames([(7, 0)], [(8, 1)]))
+
 
 if __name__ == '__main__':
     unittest.main()
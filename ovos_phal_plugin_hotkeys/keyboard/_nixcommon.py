@@ -1,13 +1,32 @@
 # -*- coding: utf-8 -*-
 import struct
 import os
+import errno
+import fcntl
+import ctypes
 import atexit
-from time import time as now
-from threading import Thread
-from queue import Queue
+import selectors
+import sysconfig
+from time import time as now, time_ns, monotonic_ns
+from collections import deque
 from glob import glob
+from threading import Lock
 from ovos_utils.log import LOG
-event_bin_format = 'llHHI'
+from ._nixhotplug import DeviceHotplug
+
+def _event_bin_format():
+    """
+    Layout of `struct input_event`: a timeval made of two kernel longs, then
+    type, code and a signed value. 32 bit processes (including armhf
+    userlands on 64 bit Raspberry Pi kernels) get the 16 byte layout, whatever
+    their time_t size, 64 bit processes and x32 get the 24 byte one.
+    """
+    if struct.calcsize('P') == 8 or 'x32' in (sysconfig.get_config_var('MULTIARCH') or ''):
+        return 'qqHHi'
+    return 'LLHHi'
+
+event_bin_format = _event_bin_format()
+event_struct = struct.Struct(event_bin_format)
 
 # Taken from include/linux/input.h
 # https://www.kernel.org/doc/Documentation/input/event-codes.txt
@@ -16,54 +35,220 @@ EV_KEY = 0x01
 EV_REL = 0x02
 EV_ABS = 0x03
 EV_MSC = 0x04
+EV_REP = 0x14
+
+SYN_REPORT = 0
+SYN_DROPPED = 3
+
+EV_CNT = 0x20
+KEY_CNT = 0x300
+
+# ioctl request numbers, see include/uapi/asm-generic/ioctl.h
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def _IOC(direction, type, number, size):
+    return (direction << 30) | (size << 16) | (ord(type) << 8) | number
+
+def _IOW(type, number, size):
+    return _IOC(_IOC_WRITE, type, number, size)
+
+def _IOR(type, number, size):
+    return _IOC(_IOC_READ, type, number, size)
+
+input_mask_struct = struct.Struct('IIQ')
+EVIOCSMASK = _IOW('E', 0x93, input_mask_struct.size)
+input_id_struct = struct.Struct('4H')
+EVIOCGID = _IOR('E', 0x02, input_id_struct.size)
+
+def EVIOCGNAME(length):
+    return _IOR('E', 0x06, length)
+
+def EVIOCGPHYS(length):
+    return _IOR('E', 0x07, length)
 
-def make_uinput():
-    if not os.path.exists('/dev/uinput'):
-        raise IOError('No uinput module found.')
+def EVIOCGBIT(type, length):
+    return _IOR('E', 0x20 + type, length)
 
-    import fcntl, struct
+def EVIOCGKEY(length):
+    return _IOR('E', 0x18, length)
 
-    # Requires uinput driver, but it's usually available.
-    uinput = open("/dev/uinput", 'wb')
-    UI_SET_EVBIT = 0x40045564
-    fcntl.ioctl(uinput, UI_SET_EVBIT, EV_KEY)
+CLOCK_MONOTONIC = 1
+EVIOCSCLOCKID = _IOW('E', 0xa0, struct.calcsize('i'))
 
-    UI_SET_KEYBIT = 0x40045565
-    for i in range(256):
-        fcntl.ioctl(uinput, UI_SET_KEYBIT, i)
+# Kernel bitmaps are arrays of native longs.
+_LONG_BITS = struct.calcsize('L') * 8
 
-    BUS_USB = 0x03
-    uinput_user_dev = "80sHHHHi64i64i64i64i"
-    axis = [0] * 64 * 4
-    uinput.write(struct.pack(uinput_user_dev, b"Virtual Keyboard", BUS_USB, 1, 1, 1, 0, *axis))
-    uinput.flush() # Without this you may get Errno 22: Invalid argument.
+def bitmap_to_bytes(mask, count):
+    """ Packs the bits of the integer `mask` as a kernel bitmap of `count` bits. """
+    words = (count + _LONG_BITS - 1) // _LONG_BITS
+    word_mask = (1 << _LONG_BITS) - 1
+    return struct.pack('{}L'.format(words), *((mask >> (i * _LONG_BITS)) & word_mask for i in range(words)))
 
-    UI_DEV_CREATE = 0x5501
-    fcntl.ioctl(uinput, UI_DEV_CREATE)
-    UI_DEV_DESTROY = 0x5502
-    #fcntl.ioctl(uinput, UI_DEV_DESTROY)
+def bitmap_size(count):
+    """ Size in bytes of a kernel bitmap of `count` bits. """
+    return (count + _LONG_BITS - 1) // _LONG_BITS * (_LONG_BITS // 8)
 
-    return uinput
+def bitmap_from_bytes(data):
+    """ Unpacks a kernel bitmap into an integer, bit N set meaning code N. """
+    words = struct.unpack('{}L'.format(len(data) // (_LONG_BITS // 8)), data)
+    return sum(word << (i * _LONG_BITS) for i, word in enumerate(words))
+
+def codes_to_mask(codes):
+    mask = 0
+    for code in codes:
+        mask |= 1 << code
+    return mask
+
+def pack_frames(frames):
+    """
+    Packs lists of (type, code, value) into a single buffer, each list
+    followed by a SYN_REPORT so other programs see its events at once.
+    """
+    integer, fraction = divmod(now(), 1)
+    seconds = int(integer)
+    microseconds = int(fraction * 1e6)
+    data = bytearray()
+    for frame in frames:
+        for type, code, value in frame:
+            data += event_struct.pack(seconds, microseconds, type, code, value)
+        data += event_struct.pack(seconds, microseconds, EV_SYN, SYN_REPORT, 0)
+    return bytes(data)
+
+UI_DEV_CREATE = 0x5501
+UI_DEV_DESTROY = 0x5502
+uinput_setup_struct = struct.Struct('4H80sI')
+UI_DEV_SETUP = _IOW('U', 3, uinput_setup_struct.size)
+UI_SET_EVBIT = _IOW('U', 100, struct.calcsize('i'))
+UI_SET_KEYBIT = _IOW('U', 101, struct.calcsize('i'))
+BUS_USB = 0x03
+
+class UInputDevice(object):
+    """
+    Virtual keyboard to send events through, created with uinput on the first
+    `write_event` so listen-only users never create one.
+
+    Only the keys from `key_codes` (a callable returning scan codes, called
+    at creation) and the keys actually written are enabled, including codes
+    above 255. Writing a key that isn't enabled recreates the device, but
+    only once no key is held on it: destroying the device releases them.
+    Until then that key is dropped by the kernel.
+    """
+    name = 'ovos-PHAL-plugin-hotkeys virtual keyboard'
+    path = 'uinput Fake Device'
+
+    def __init__(self, key_codes=lambda: range(1, 256)):
+        self.key_codes = key_codes
+        self.enabled = frozenset()
+        # Keys written so far, enabled on the next creation.
+        self.written = set()
+        # Keys held down on the device.
+        self.pressed = set()
+        self._file = None
+        atexit.register(self.close)
+
+    def _create(self):
+        if not os.path.exists('/dev/uinput'):
+            raise IOError('No uinput module found.')
+
+        codes = frozenset(self.key_codes()) | self.enabled | self.written
+        uinput = open('/dev/uinput', 'wb', buffering=0)
+        try:
+            fcntl.ioctl(uinput, UI_SET_EVBIT, EV_KEY)
+            for code in sorted(codes):
+                if 0 <= code < KEY_CNT:
+                    fcntl.ioctl(uinput, UI_SET_KEYBIT, code)
+
+            name = self.name.encode()
+            try:
+                fcntl.ioctl(uinput, UI_DEV_SETUP, uinput_setup_struct.pack(BUS_USB, 1, 1, 1, name, 0))
+            except OSError:
+                # Kernels older than 4.5 only take the legacy uinput_user_dev.
+                uinput_user_dev = "80sHHHHi64i64i64i64i"
+                axis = [0] * 64 * 4
+                uinput.write(struct.pack(uinput_user_dev, name, BUS_USB, 1, 1, 1, 0, *axis))
+            fcntl.ioctl(uinput, UI_DEV_CREATE)
+        except:
+            uinput.close()
+            raise
+        self._file = uinput
+        self.enabled = codes
+
+    def write_event(self, type, code, value):
+        self.write_events([[(type, code, value)]])
+
+    def write_events(self, frames):
+        """ Writes lists of (type, code, value), see `pack_frames`. """
+        codes = set(code for frame in frames for type, code, value in frame if type == EV_KEY)
+        self.written.update(codes)
+        if self._file is not None and not self.written <= self.enabled and not self.pressed:
+            # Enabling keys is only possible before UI_DEV_CREATE.
+            self.close()
+        if self._file is None:
+            self._create()
+        elif not codes <= self.enabled:
+            LOG.warning(f"Keys {sorted(codes - self.enabled)} are not enabled on the virtual "
+                        f"keyboard, dropped until keys {sorted(self.pressed)} are released.")
+        self._file.write(pack_frames(frames))
+        for frame in frames:
+            for type, code, value in frame:
+                if type != EV_KEY or code not in self.enabled:
+                    continue
+                if value:
+                    self.pressed.add(code)
+                else:
+                    self.pressed.discard(code)
+
+    def close(self):
+        """ Destroys the virtual device, it is created again if needed. """
+        if self._file is None:
+            return
+        try:
+            fcntl.ioctl(self._file, UI_DEV_DESTROY)
+        except OSError:
+            pass
+        self._file.close()
+        self._file = None
+        self.pressed.clear()
 
 class EventDevice(object):
+    # Maximum number of events decoded per read syscall.
+    read_batch = 64
+
     def __init__(self, path):
         self.path = path
         self._input_file = None
         self._output_file = None
+        self._view = None
+        self._frame = []
+        # Masks from `set_event_mask`, as bitmasks or None, and if they must
+        # be applied in `read_frames` because the kernel can't.
+        self._type_mask = None
+        self._key_mask = None
+        self._filter_in_userspace = False
+        # Bitmask of the keys reported as pressed, to resync after drops.
+        self.pressed = 0
+        self._dropping = False
+        # If the kernel stamps our events with CLOCK_MONOTONIC, otherwise
+        # timestamps are converted from the wall clock as they are read.
+        self.monotonic = False
 
     @property
     def input_file(self):
         if self._input_file is None:
             try:
-                self._input_file = open(self.path, 'rb')
+                # Unbuffered, so each read is a single syscall and no events
+                # hide in a userspace buffer while the fd polls as idle.
+                self._input_file = open(self.path, 'rb', buffering=0)
             except IOError as e:
                 if e.strerror == 'Permission denied':
                     LOG.error(f"Failed to read device '{self.path}'. You must be in the 'input' group to access global events. Use 'sudo usermod -a -G input USERNAME' to add user to the required group.")
-                    raise
+                raise
+            self.monotonic = self._set_monotonic_clock()
 
             def try_close():
                 try:
-                    self._input_file.close
+                    self._input_file.close()
                 except:
                     pass
             atexit.register(try_close)
@@ -76,75 +261,635 @@ class EventDevice(object):
             atexit.register(self._output_file.close)
         return self._output_file
 
+    def _set_monotonic_clock(self):
+        """
+        Asks the kernel to timestamp events with CLOCK_MONOTONIC, immune to
+        NTP steps, so event times can be compared with `time.monotonic()`.
+        """
+        try:
+            fcntl.ioctl(self._input_file, EVIOCSCLOCKID, struct.pack('i', CLOCK_MONOTONIC))
+            return True
+        except OSError as e:
+            LOG.debug(f"EVIOCSCLOCKID not available for '{self.path}', converting wall clock timestamps: {e}")
+            return False
+
+    def _clock_offset_ns(self):
+        return 0 if self.monotonic else monotonic_ns() - time_ns()
+
     def read_event(self):
-        data = self.input_file.read(struct.calcsize(event_bin_format))
-        seconds, microseconds, type, code, value = struct.unpack(event_bin_format, data)
-        return seconds + microseconds / 1e6, type, code, value, self.path
+        """
+        Reads a single event as a (time_ns, type, code, value, path) tuple,
+        `time_ns` being integer nanoseconds of the monotonic clock.
+        """
+        data = self.input_file.read(event_struct.size)
+        seconds, microseconds, type, code, value = event_struct.unpack(data)
+        return seconds * 1000000000 + microseconds * 1000 + self._clock_offset_ns(), type, code, value, self.path
 
-    def write_event(self, type, code, value):
-        integer, fraction = divmod(now(), 1)
-        seconds = int(integer)
-        microseconds = int(fraction * 1e6)
-        data_event = struct.pack(event_bin_format, seconds, microseconds, type, code, value)
+    def read_frames(self):
+        """
+        Reads every available event (up to `read_batch`) with a single
+        syscall into a reusable buffer and returns the list of complete
+        frames, i.e. lists of events delimited by SYN_REPORT, each event
+        being a tuple like the ones from `read_event`. SYN events
+        themselves are not included, incomplete frames are kept for the next
+        call.
+
+        When the kernel buffer overflows (SYN_DROPPED) the partial data is
+        discarded up to the next SYN_REPORT, and replaced by a frame with the
+        key transitions missed in between, see `resync`.
+        """
+        if self._view is None:
+            self._view = memoryview(bytearray(event_struct.size * self.read_batch))
+        size = self.input_file.readinto(self._view)
+        if not size:
+            raise OSError(errno.ENODEV, 'Device closed', self.path)
+        size -= size % event_struct.size
+
+        path = self.path
+        offset = self._clock_offset_ns()
+        frame = self._frame
+        frames = []
+        if self._filter_in_userspace:
+            type_mask = self._type_mask
+            key_mask = self._key_mask
+        else:
+            type_mask = key_mask = None
+        for seconds, microseconds, type, code, value in event_struct.iter_unpack(self._view[:size]):
+            if type == EV_SYN:
+                if code == SYN_REPORT:
+                    if self._dropping:
+                        self._dropping = False
+                        frame = self.resync()
+                    elif frame:
+                        self._track_pressed(frame)
+                    if frame:
+                        frames.append(frame)
+                        frame = []
+                elif code == SYN_DROPPED:
+                    LOG.debug(f"Events dropped by the kernel for '{path}', resyncing")
+                    self._dropping = True
+                    frame = []
+                continue
+            if self._dropping:
+                continue
+            if type_mask is not None and not (type_mask >> type) & 1:
+                continue
+            if key_mask is not None and type == EV_KEY and not (key_mask >> code) & 1:
+                continue
+            frame.append((seconds * 1000000000 + microseconds * 1000 + offset, type, code, value, path))
+        self._frame = frame
+        return frames
+
+    def _track_pressed(self, frame):
+        pressed = self.pressed
+        for time, type, code, value, path in frame:
+            if type == EV_KEY:
+                if value == 1:
+                    pressed |= 1 << code
+                elif value == 0:
+                    pressed &= ~(1 << code)
+        self.pressed = pressed
+
+    def resync(self):
+        """
+        Reads the state of all keys with EVIOCGKEY and returns a frame of
+        synthesized key events for the differences with what was reported so
+        far: downs for keys pressed behind our back, ups for keys released.
+        Used when attaching the device and after SYN_DROPPED.
+        """
+        size = bitmap_size(KEY_CNT)
+        try:
+            state = bitmap_from_bytes(fcntl.ioctl(self.input_file, EVIOCGKEY(size), bytes(size)))
+        except OSError as e:
+            LOG.debug(f"Failed to read key state of '{self.path}': {e}")
+            return []
+        if self._key_mask is not None:
+            state &= self._key_mask
+        return self._sync_to(state)
 
-        # Send a sync event to ensure other programs update.
-        sync_event = struct.pack(event_bin_format, seconds, microseconds, EV_SYN, 0, 0)
+    def release_all(self):
+        """
+        Returns a frame of synthesized key ups for the keys reported as
+        pressed, for when the device goes away with keys held.
+        """
+        return self._sync_to(0)
 
-        self.output_file.write(data_event + sync_event)
+    def _sync_to(self, state):
+        time = monotonic_ns()
+        frame = []
+        changed = state ^ self.pressed
+        code = 0
+        while changed:
+            if changed & 1:
+                frame.append((time, EV_KEY, code, int((state >> code) & 1), self.path))
+            changed >>= 1
+            code += 1
+        self.pressed = state
+        return frame
+
+    def set_event_mask(self, types, key_codes=None):
+        """
+        Only receive events of the given types and, if given, EV_KEY events
+        of the given codes. Uses EVIOCSMASK so the kernel drops everything
+        else (and the resulting empty frames) before waking us up, falling
+        back to filtering in `read_frames` on kernels without it (< 4.4).
+        """
+        type_mask = codes_to_mask(types)
+        key_mask = None if key_codes is None else codes_to_mask(key_codes)
+        try:
+            self._ioctl_mask(0, type_mask, EV_CNT)
+            if key_mask is not None:
+                self._ioctl_mask(EV_KEY, key_mask, KEY_CNT)
+            else:
+                self._ioctl_mask(EV_KEY, (1 << KEY_CNT) - 1, KEY_CNT)
+            self._filter_in_userspace = False
+        except (OSError, ValueError) as e:
+            LOG.debug(f"EVIOCSMASK not available for '{self.path}', filtering events in userspace: {e}")
+            self._filter_in_userspace = True
+        self._type_mask = type_mask
+        self._key_mask = key_mask
+        if key_mask is not None:
+            self.pressed &= key_mask
+
+    def _ioctl_mask(self, type, mask, count):
+        data = bitmap_to_bytes(mask, count)
+        codes = ctypes.create_string_buffer(data, len(data))
+        request = input_mask_struct.pack(type, len(codes.raw), ctypes.addressof(codes))
+        fcntl.ioctl(self.input_file, EVIOCSMASK, request)
+
+    def write_event(self, type, code, value):
+        self.write_events([[(type, code, value)]])
+
+    def write_events(self, frames):
+        # The sync events ensure other programs update.
+        self.output_file.write(pack_frames(frames))
         self.output_file.flush()
 
+class DeviceStats(object):
+    """ Read counters of a single device in an `AggregatedEventDevice`. """
+    __slots__ = ('reads', 'events', 'errors', 'debounced')
+
+    def __init__(self):
+        self.reads = 0
+        self.events = 0
+        self.errors = 0
+        self.debounced = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return 'DeviceStats(reads={}, events={}, errors={}, debounced={})'.format(self.reads, self.events, self.errors, self.debounced)
+
+class Debouncer(object):
+    """
+    Drops key changes arriving less than a window after the last accepted
+    change of the same key on the same device, like the contact bounce of
+    gpio buttons. If the key ends the window in a different state than the
+    one accepted, that state is emitted when the window ends (see `flush`),
+    so presses and releases are never lost, only delayed.
+
+    - `window` in seconds, for all keys if `windows` is None.
+    - `windows` a dict of scan code -> window, only these keys are debounced.
+    - `clock_ns` returns the current time in nanoseconds, on the clock of the
+    event timestamps, `time.monotonic_ns` by default.
+    """
+    def __init__(self, window=0.0, windows=None, clock_ns=monotonic_ns):
+        self.clock_ns = clock_ns
+        self.window_ns = int(window * 1e9)
+        self.windows_ns = None if windows is None else {code: int(w * 1e9) for code, w in windows.items()}
+        self.suppressed = 0
+        self.flushed = 0
+        # (path, code) -> [accepted value, end of window, last value seen]
+        self._keys = {}
+        # Keys to emit when their window ends.
+        self._dirty = set()
+
+    def _window_ns(self, code):
+        if self.windows_ns is None:
+            return self.window_ns
+        return self.windows_ns.get(code, 0)
+
+    def accept(self, event):
+        """ Returns False if `event`, as returned by `EventDevice.read_event`, is a bounce. """
+        event_ns, type, code, value, path = event
+        if type != EV_KEY or value == 2:
+            return True
+        window_ns = self._window_ns(code)
+        if not window_ns:
+            return True
+        key = (path, code)
+        state = self._keys.get(key)
+        if state is None or event_ns >= state[1]:
+            self._keys[key] = [value, event_ns + window_ns, value]
+            self._dirty.discard(key)
+            return True
+        state[2] = value
+        if value != state[0]:
+            self._dirty.add(key)
+        else:
+            self._dirty.discard(key)
+        self.suppressed += 1
+        return False
+
+    def timeout(self):
+        """ Seconds until the next `flush` is due, None if nothing is pending. """
+        if not self._dirty:
+            return None
+        end = min(self._keys[key][1] for key in self._dirty)
+        return max(0, end - self.clock_ns()) / 1e9
+
+    def flush(self):
+        """ Returns the events of keys that ended their window in a new state. """
+        if not self._dirty:
+            return []
+        now_ns = self.clock_ns()
+        events = []
+        for key in list(self._dirty):
+            state = self._keys[key]
+            if state[1] <= now_ns:
+                path, code = key
+                self._dirty.discard(key)
+                # A new change, with its own window.
+                state[0] = state[2]
+                state[1] = now_ns + self._window_ns(code)
+                events.append((now_ns, EV_KEY, code, state[2], path))
+                self.flushed += 1
+        return events
+
+    def forget(self, path):
+        for key in [key for key in self._keys if key[0] == path]:
+            del self._keys[key]
+            self._dirty.discard(key)
+
 class AggregatedEventDevice(object):
-    def __init__(self, devices, output=None):
-        self.event_queue = Queue()
-        self.devices = devices
-        self.output = output or self.devices[0]
-        def start_reading(device):
-            while True:
-                if device.input_file.readable():
-                    self.event_queue.put(device.read_event())
-        for device in self.devices:
-            thread = Thread(target=start_reading, args=[device])
-            thread.daemon = True
-            thread.start()
+    """
+    Reads events from many devices in the calling thread, waiting on all
+    their file descriptors at once with `selectors` (epoll on Linux) instead
+    of running one thread per device.
+
+    If `hotplug` (a `DeviceHotplug`) is given, devices plugged in later are
+    attached and unplugged ones detached as they come and go. If `scan_codes`
+    is given, only devices able to emit at least one of them are attached.
+    """
+    def __init__(self, devices, output=None, hotplug=None, scan_codes=None):
+        self.devices = []
+        self.output = output or (devices[0] if devices else None)
+        self.stats = {}
+        # A `Debouncer`, if any, see `set_debounce`.
+        self.debouncer = None
+        self.event_mask = None
+        # Devices that can't emit any of these are not attached, if not None.
+        self.scan_codes = scan_codes
+        self.hotplug = hotplug
+        self._pending = deque()
+        self._selector = selectors.DefaultSelector()
+        for device in devices:
+            if self._can_emit(device.path):
+                self.add_device(device)
+        if hotplug is not None and hotplug.fileno() is not None:
+            self._selector.register(hotplug.fileno(), selectors.EVENT_READ, hotplug)
+        # Mask changes from other threads wait here for the reading thread,
+        # which owns the devices, woken up by a byte on the pipe.
+        self._mask_lock = Lock()
+        self._requested_mask = None
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+
+    def set_event_mask(self, types, key_codes=None):
+        """
+        Applies `EventDevice.set_event_mask` to current and future devices,
+        detaching devices that can't emit any of `key_codes`. Safe to call
+        from any thread: the change is made by the thread in `read_event`,
+        before it returns its next event.
+        """
+        with self._mask_lock:
+            self._requested_mask = (types, key_codes)
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except BlockingIOError:
+            # Already full of wakeups.
+            pass
+
+    def _apply_event_mask(self):
+        with self._mask_lock:
+            mask, self._requested_mask = self._requested_mask, None
+        if mask is None:
+            return
+        types, key_codes = mask
+        self.event_mask = mask
+        self.scan_codes = key_codes
+        for device in list(self.devices):
+            if not self._can_emit(device.path):
+                LOG.debug(f"Detaching '{device.path}', it can't emit any of the configured keys")
+                self.remove_device(device)
+            else:
+                device.set_event_mask(types, key_codes)
+
+    def set_debounce(self, debouncer):
+        self.debouncer = debouncer
+
+    def _can_emit(self, path):
+        if self.scan_codes is None:
+            return True
+        try:
+            return describe_device(path).can_emit(self.scan_codes)
+        except OSError:
+            return True
+
+    def add_device(self, device):
+        if self.event_mask:
+            device.set_event_mask(*self.event_mask)
+        self._selector.register(device.input_file, selectors.EVENT_READ, device)
+        self.devices.append(device)
+        self.stats.setdefault(device.path, DeviceStats())
+        # Don't miss keys that were already pressed.
+        self._pending.extend(device.resync())
+
+    def remove_device(self, device):
+        try:
+            self._selector.unregister(device.input_file)
+        except (KeyError, ValueError):
+            pass
+        if device in self.devices:
+            self.devices.remove(device)
+        if self.debouncer is not None:
+            self.debouncer.forget(device.path)
+        # Keys held on it would otherwise stay pressed forever.
+        self._pending.extend(device.release_all())
+        try:
+            device.input_file.close()
+        except OSError:
+            pass
+
+    def _attach(self, path):
+        # Devices found through by-id/by-path are symlinks to the event nodes.
+        if any(os.path.realpath(device.path) == path for device in self.devices):
+            self.hotplug.attached(path)
+            return
+        if not self._can_emit(path):
+            self.hotplug.attached(path)
+            return
+        device = EventDevice(path)
+        try:
+            self.add_device(device)
+        except OSError as e:
+            # udev may not have fixed the permissions yet.
+            LOG.debug(f"Failed to attach '{path}', retrying later: {e}")
+            self.hotplug.retry_later(path)
+            return
+        self.hotplug.attached(path)
+        LOG.info(f"Attached input device '{path}'")
+
+    def _detach(self, path):
+        # Also when it was already removed after a read error.
+        forget_device(path)
+        for device in list(self.devices):
+            if os.path.realpath(device.path) == path:
+                forget_device(device.path)
+                self.remove_device(device)
+                LOG.info(f"Detached input device '{path}'")
+
+    def _handle_hotplug(self, readable):
+        for path, present in self.hotplug.changes(readable):
+            if present:
+                self._attach(path)
+            else:
+                self._detach(path)
 
     def read_event(self):
-        return self.event_queue.get(block=True)
+        while True:
+            if self._requested_mask is not None:
+                self._apply_event_mask()
+            if self._pending:
+                return self._pending.popleft()
+            timeout = self.hotplug.timeout() if self.hotplug else None
+            debouncer = self.debouncer
+            if debouncer is not None:
+                debounce_timeout = debouncer.timeout()
+                if debounce_timeout is not None:
+                    timeout = debounce_timeout if timeout is None else min(timeout, debounce_timeout)
+            hotplug_readable = False
+            for key, _ in self._selector.select(timeout):
+                device = key.data
+                if device is None:
+                    try:
+                        os.read(self._wakeup_read, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if device is self.hotplug:
+                    hotplug_readable = True
+                    continue
+                stats = self.stats[device.path]
+                try:
+                    frames = device.read_frames()
+                except (OSError, ValueError) as e:
+                    # Usually ENODEV, the device was unplugged.
+                    LOG.warning(f"Failed to read from '{device.path}', detaching it: {e}")
+                    stats.errors += 1
+                    self.remove_device(device)
+                    if self.hotplug and os.path.exists(device.path):
+                        self.hotplug.retry_later(device.path)
+                    continue
+                stats.reads += 1
+                for frame in frames:
+                    stats.events += len(frame)
+                    if debouncer is None:
+                        self._pending.extend(frame)
+                        continue
+                    for event in frame:
+                        if debouncer.accept(event):
+                            self._pending.append(event)
+                        else:
+                            stats.debounced += 1
+            if debouncer is not None:
+                self._pending.extend(debouncer.flush())
+            if self.hotplug:
+                self._handle_hotplug(hotplug_readable)
 
     def write_event(self, type, code, value):
-        self.output.write_event(type, code, value)
+        self.write_events([[(type, code, value)]])
+
+    def write_events(self, frames):
+        if self.output is None:
+            raise IOError(errno.ENODEV, 'No device to send events through: /dev/uinput is unavailable and no input device was found')
+        self.output.write_events(frames)
+
+    def close_output(self):
+        if isinstance(self.output, UInputDevice):
+            self.output.close()
+
+    def close(self):
+        """ Closes the devices and the wakeup pipe, but not the output. """
+        for device in list(self.devices):
+            self.remove_device(device)
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
 
 import re
 from collections import namedtuple
 DeviceDescription = namedtuple('DeviceDescription', 'event_file is_keyboard')
 device_pattern = r"""N: Name="([^"]+?)".+?H: Handlers=([^\n]+)"""
-def list_devices_from_proc(type_name):
+
+class DeviceInfo(namedtuple('DeviceInfo', 'path name phys bustype vendor product version handlers capabilities')):
+    """
+    Description of an input device node. `capabilities` maps each event type
+    supported by the device to the bitmask of its codes, from EVIOCGBIT.
+    """
+    __slots__ = ()
+
+    def can_emit(self, scan_codes):
+        keys = self.capabilities.get(EV_KEY, 0)
+        return any((keys >> scan_code) & 1 for scan_code in scan_codes)
+
+    @property
+    def repeats(self):
+        """ If the kernel sends autorepeat events (value 2) for held keys. """
+        return EV_REP in self.capabilities
+
+def _ioctl_string(fd, request):
+    try:
+        return fcntl.ioctl(fd, request(256), bytes(256)).split(b'\0', 1)[0].decode(errors='replace')
+    except OSError:
+        # Virtual devices have no physical path, for example.
+        return ''
+
+# path -> ((inode, ctime), DeviceInfo)
+_device_info_cache = {}
+
+def describe_device(path, handlers=None):
+    """
+    Queries the name, physical path, ids and capability bitmaps of an input
+    device node. Results are cached until the node is replaced or
+    `forget_device` is called.
+    """
+    stat = os.stat(path)
+    node = (stat.st_ino, stat.st_ctime_ns)
+    cached = _device_info_cache.get(path)
+    if cached and cached[0] == node:
+        return cached[1]
+
+    if handlers is None:
+        handlers = read_proc_handlers().get(os.path.basename(os.path.realpath(path)), ())
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        name = _ioctl_string(fd, EVIOCGNAME)
+        phys = _ioctl_string(fd, EVIOCGPHYS)
+        bustype, vendor, product, version = input_id_struct.unpack(fcntl.ioctl(fd, EVIOCGID, bytes(input_id_struct.size)))
+        size = bitmap_size(EV_CNT)
+        types = bitmap_from_bytes(fcntl.ioctl(fd, EVIOCGBIT(0, size), bytes(size)))
+        capabilities = {}
+        size = bitmap_size(KEY_CNT)
+        for type in range(1, EV_CNT):
+            if (types >> type) & 1:
+                capabilities[type] = bitmap_from_bytes(fcntl.ioctl(fd, EVIOCGBIT(type, size), bytes(size)))
+    finally:
+        os.close(fd)
+
+    info = DeviceInfo(path, name, phys, bustype, vendor, product, version, tuple(handlers), capabilities)
+    _device_info_cache[path] = (node, info)
+    return info
+
+# path -> DeviceInfo.repeats, see `device_repeats`
+_device_repeats_cache = {}
+
+def device_repeats(path):
+    """
+    If the kernel autorepeats keys held on the device, True when it can't be
+    queried. Unlike `describe_device` the node isn't checked again, the
+    result is kept until `forget_device`, called when the device goes away.
+    """
+    repeats = _device_repeats_cache.get(path)
+    if repeats is None:
+        try:
+            repeats = describe_device(path).repeats
+        except OSError:
+            repeats = True
+        _device_repeats_cache[path] = repeats
+    return repeats
+
+def forget_device(path):
+    _device_info_cache.pop(path, None)
+    _device_repeats_cache.pop(path, None)
+
+def read_proc_handlers():
+    """
+    Returns a dict of event node name ("event3") -> list of handlers, for all
+    devices but our own `UInputDevice`.
+    """
     try:
         with open('/proc/bus/input/devices') as f:
             description = f.read()
     except FileNotFoundError:
-        return
-
-    devices = {}
+        return {}
+    nodes = {}
     for name, handlers in re.findall(device_pattern, description, re.DOTALL):
-        path = '/dev/input/event' + re.search(r'event(\d+)', handlers).group(1)
-        if type_name in handlers:
-            yield EventDevice(path)
+        if name == UInputDevice.name:
+            continue
+        handlers = handlers.split()
+        for handler in handlers:
+            if handler.startswith('event'):
+                nodes[handler] = handlers
+    return nodes
+
+def list_input_devices(type_name=None):
+    """
+    Returns a `DeviceInfo` for each input device, optionally only those with
+    the given handler (e.g. "kbd"). Devices that can't be opened are skipped.
+    """
+    devices = []
+    for node, handlers in sorted(read_proc_handlers().items()):
+        if type_name is not None and type_name not in handlers:
+            continue
+        try:
+            devices.append(describe_device('/dev/input/' + node, handlers))
+        except OSError as e:
+            LOG.debug(f"Failed to describe '/dev/input/{node}': {e}")
+    return devices
+
+def list_devices_from_proc(type_name, scan_codes=None):
+    """
+    Yields an `EventDevice` for each device with the handler `type_name` and,
+    if `scan_codes` is given, able to emit at least one of them.
+    """
+    for node, handlers in sorted(read_proc_handlers().items()):
+        if type_name not in handlers:
+            continue
+        path = '/dev/input/' + node
+        if scan_codes is not None:
+            try:
+                if not describe_device(path, handlers).can_emit(scan_codes):
+                    LOG.debug(f"Skipping '{path}', it can't emit any of the configured keys")
+                    continue
+            except OSError as e:
+                # Let opening the device report the problem.
+                LOG.debug(f"Failed to query capabilities of '{path}': {e}")
+        yield EventDevice(path)
+
+def device_has_handler(path, type_name):
+    """ Checks a single device node against /proc/bus/input/devices. """
+    handlers = read_proc_handlers()
+    if not handlers:
+        return True
+    return type_name in handlers.get(os.path.basename(path), ())
 
 def list_devices_from_by_id(name_suffix, by_id=True):
     for path in glob('/dev/input/{}/*-event-{}'.format('by-id' if by_id else 'by-path', name_suffix)):
         yield EventDevice(path)
 
-def aggregate_devices(type_name):
+def aggregate_devices(type_name, hotplug=True, scan_codes=None, output_key_codes=None):
     # Some systems have multiple keyboards with different range of allowed keys
     # on each one, like a notebook with a "keyboard" device exclusive for the
     # power button. Instead of figuring out which keyboard allows which key to
     # send events, we create a fake device and send all events through there.
-    try:
-        uinput = make_uinput()
-        fake_device = EventDevice('uinput Fake Device')
-        fake_device._input_file = uinput
-        fake_device._output_file = uinput
-    except IOError as e:
+    # It's only created when the first event is sent.
+    if os.path.exists('/dev/uinput'):
+        fake_device = UInputDevice(output_key_codes) if output_key_codes else UInputDevice()
+    else:
         import warnings
         warnings.warn('Failed to create a device file using `uinput` module. Sending of events may be limited or unavailable depending on plugged-in devices.', stacklevel=2)
         fake_device = None
@@ -152,14 +897,15 @@ def aggregate_devices(type_name):
     # We don't aggregate devices from different sources to avoid
     # duplicates.
 
-    devices_from_proc = list(list_devices_from_proc(type_name))
-    if devices_from_proc:
-        return AggregatedEventDevice(devices_from_proc, output=fake_device)
-
-    devices_from_by_id = list(list_devices_from_by_id(type_name)) or list(list_devices_from_by_id(type_name, by_id=False))
-    if devices_from_by_id:
-        return AggregatedEventDevice(devices_from_by_id, output=fake_device)
+    if hotplug:
+        hotplug = DeviceHotplug(lambda path: device_has_handler(path, type_name))
+    else:
+        hotplug = None
 
-    # If no keyboards were found we can only use the fake device to send keys.
-    assert fake_device
-    return fake_device
+    devices = list(list_devices_from_proc(type_name, scan_codes))
+    if not devices and not read_proc_handlers():
+        devices = list(list_devices_from_by_id(type_name)) or list(list_devices_from_by_id(type_name, by_id=False))
+    if not devices and not hotplug:
+        # If no keyboards were found we can only use the fake device to send keys.
+        assert fake_device
+    return AggregatedEventDevice(devices, output=fake_device, hotplug=hotplug, scan_codes=scan_codes)
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+from threading import Timer
+from unittest.mock import patch
+
+from . import _nixcommon
+from ._nixhotplug import DeviceHotplug
+from ._nixhotplug_tests import FakeWatcher
+from ._nixcommon import UInputDevice, EventDevice, AggregatedEventDevice, DeviceInfo, Debouncer, EV_KEY, EV_REP, EV_SYN, EV_MSC, SYN_REPORT, SYN_DROPPED, event_struct, pack_frames
+
+"""
+Tests of the Linux evdev/uinput layer that don't need real devices: event
+devices are read from pipes and the virtual keyboard writes to /dev/null.
+"""
+
+class FakeUInputDevice(UInputDevice):
+    def __init__(self, key_codes):
+        UInputDevice.__init__(self, key_codes)
+        self.created = []
+
+    def _create(self):
+        # ioctls on /dev/null fail, destroying it is a no-op.
+        self._file = open('/dev/null', 'wb', buffering=0)
+        self.enabled = frozenset(self.key_codes()) | self.enabled | self.written
+        self.created.append(self.enabled)
+
+def key(code, value):
+    return [(EV_KEY, code, value), (EV_SYN, 0, 0)]
+
+def pipe_device(test, path='/dev/input/event-test'):
+    """ An EventDevice reading from a pipe, returns (device, write fd). """
+    read, write = os.pipe()
+    device = EventDevice(path)
+    device._input_file = os.fdopen(read, 'rb', buffering=0)
+    device.monotonic = True
+    test.addCleanup(device._input_file.close)
+    return device, write
+
+def event_fields(events):
+    return [(type, code, value) for time, type, code, value, path in events]
+
+class TestUInputDevice(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeUInputDevice(lambda: {30, 31})
+        self.addCleanup(self.device.close)
+
+    def test_created_once(self):
+        self.device.write_events([key(30, 1), key(30, 0)])
+        self.device.write_events([key(31, 1), key(31, 0)])
+        self.assertEqual(self.device.created, [{30, 31}])
+
+    def test_new_key_recreates(self):
+        self.device.write_events([key(30, 1), key(30, 0)])
+        self.device.write_events([key(582, 1), key(582, 0)])
+        self.assertEqual(self.device.created, [{30, 31}, {30, 31, 582}])
+
+    def test_no_recreate_while_pressed(self):
+        self.device.write_events([key(30, 1)])
+        self.device.write_events([key(582, 1), key(582, 0)])
+        self.assertEqual(self.device.created, [{30, 31}])
+        self.assertEqual(self.device.pressed, {30})
+        self.device.write_events([key(30, 0)])
+        self.assertEqual(self.device.created, [{30, 31}])
+        # Recreated as soon as nothing is held.
+        self.device.write_events([key(31, 1)])
+        self.assertEqual(self.device.created, [{30, 31}, {30, 31, 582}])
+        self.assertEqual(self.device.pressed, {31})
+
+def raw(*events):
+    """ Packs (type, code, value) events as the kernel does, 1ms apart. """
+    return b''.join(event_struct.pack(1, i * 1000, type, code, value) for i, (type, code, value) in enumerate(events))
+
+SYN = (EV_SYN, SYN_REPORT, 0)
+
+class TestEventDevice(unittest.TestCase):
+    def setUp(self):
+        self.device, self.write = pipe_device(self)
+        self.addCleanup(os.close, self.write)
+
+    def read(self, *events):
+        os.write(self.write, raw(*events))
+        return [event_fields(frame) for frame in self.device.read_frames()]
+
+    def test_frames(self):
+        frames = self.read((EV_KEY, 29, 1), (EV_KEY, 30, 1), SYN, (EV_KEY, 30, 0), SYN)
+        self.assertEqual(frames, [[(EV_KEY, 29, 1), (EV_KEY, 30, 1)], [(EV_KEY, 30, 0)]])
+        self.assertEqual(self.device.pressed, 1 << 29)
+
+    def test_timestamps(self):
+        os.write(self.write, raw((EV_KEY, 30, 1), SYN))
+        (frame,) = self.device.read_frames()
+        self.assertEqual(frame, [(1000000000, EV_KEY, 30, 1, self.device.path)])
+
+    def test_partial_frame(self):
+        self.assertEqual(self.read((EV_KEY, 29, 1), (EV_KEY, 30, 1)), [])
+        self.assertEqual(self.read((EV_KEY, 31, 1), SYN), [[(EV_KEY, 29, 1), (EV_KEY, 30, 1), (EV_KEY, 31, 1)]])
+
+    def test_read_batch(self):
+        self.device.read_batch = 3
+        frames = self.read((EV_KEY, 30, 1), SYN, (EV_KEY, 30, 0), SYN, (EV_KEY, 31, 1), SYN)
+        self.assertEqual(frames, [[(EV_KEY, 30, 1)]])
+        # The rest is read by the next calls, the partial frame kept in between.
+        self.assertEqual([event_fields(frame) for frame in self.device.read_frames()],
+                         [[(EV_KEY, 30, 0)], [(EV_KEY, 31, 1)]])
+
+    def test_dropped(self):
+        self.read((EV_KEY, 30, 1), SYN)
+        # The kernel state at the next SYN_REPORT, see resync.
+        self.device.resync = lambda: [(0, EV_KEY, 30, 0, self.device.path)]
+        frames = self.read((EV_KEY, 31, 1), (EV_SYN, SYN_DROPPED, 0), (EV_KEY, 31, 0), (EV_KEY, 30, 0), SYN,
+                           (EV_KEY, 32, 1), SYN)
+        self.assertEqual(frames, [[(EV_KEY, 30, 0)], [(EV_KEY, 32, 1)]])
+
+    def test_dropped_without_changes(self):
+        self.device.resync = lambda: []
+        frames = self.read((EV_SYN, SYN_DROPPED, 0), (EV_KEY, 31, 1), SYN, (EV_KEY, 32, 1), SYN)
+        self.assertEqual(frames, [[(EV_KEY, 32, 1)]])
+
+    def test_userspace_mask(self):
+        # EVIOCSMASK fails on a pipe.
+        self.device.set_event_mask((EV_KEY,), [30])
+        frames = self.read((EV_MSC, 4, 458756), (EV_KEY, 30, 1), SYN, (EV_KEY, 31, 1), SYN, (EV_KEY, 30, 0), SYN)
+        self.assertEqual(frames, [[(EV_KEY, 30, 1)], [(EV_KEY, 30, 0)]])
+
+    def test_closed(self):
+        device, write = pipe_device(self)
+        os.close(write)
+        with self.assertRaises(OSError):
+            device.read_frames()
+
+class TestAggregatedEventDevice(unittest.TestCase):
+    def test_unplugged_releases_keys(self):
+        device, write = pipe_device(self)
+        aggregated = AggregatedEventDevice([device])
+        self.addCleanup(aggregated.close)
+        os.write(write, pack_frames([[(EV_KEY, 30, 1)], [(EV_KEY, 31, 1)], [(EV_KEY, 31, 0)]]))
+        events = [aggregated.read_event() for _ in range(3)]
+        self.assertEqual(event_fields(events), [(EV_KEY, 30, 1), (EV_KEY, 31, 1), (EV_KEY, 31, 0)])
+        # Reading the closed pipe fails like an unplugged device.
+        os.close(write)
+        self.assertEqual(event_fields([aggregated.read_event()]), [(EV_KEY, 30, 0)])
+        self.assertEqual(aggregated.devices, [])
+        self.assertEqual(aggregated.stats[device.path].errors, 1)
+
+    def test_removed_releases_keys(self):
+        device, write = pipe_device(self)
+        self.addCleanup(os.close, write)
+        aggregated = AggregatedEventDevice([device])
+        self.addCleanup(aggregated.close)
+        os.write(write, pack_frames([[(EV_KEY, 30, 1)]]))
+        aggregated.read_event()
+        aggregated.remove_device(device)
+        aggregated.remove_device(device)
+        self.assertEqual(event_fields([aggregated.read_event()]), [(EV_KEY, 30, 0)])
+        self.assertEqual(device.pressed, 0)
+
+    def test_mask_from_other_thread(self):
+        device, write = pipe_device(self)
+        self.addCleanup(os.close, write)
+        aggregated = AggregatedEventDevice([device])
+        self.addCleanup(aggregated.close)
+        os.write(write, pack_frames([[(EV_KEY, 30, 1)]]))
+        aggregated.read_event()
+        info = DeviceInfo(device.path, 'test', '', 0, 0, 0, 0, ('kbd',), {EV_KEY: 1 << 31})
+        timer = Timer(0.05, aggregated.set_event_mask, ((EV_KEY,), [30]))
+        with patch.object(_nixcommon, 'describe_device', return_value=info):
+            # The device is left alone until this thread, blocked reading,
+            # is woken up to detach it.
+            timer.start()
+            self.assertEqual(aggregated.devices, [device])
+            self.assertEqual(event_fields([aggregated.read_event()]), [(EV_KEY, 30, 0)])
+        timer.join()
+        self.assertEqual(aggregated.devices, [])
+        self.assertEqual(aggregated.scan_codes, [30])
+
+    def test_multiplexed(self):
+        first, first_write = pipe_device(self, '/dev/input/event-first')
+        second, second_write = pipe_device(self, '/dev/input/event-second')
+        for write in (first_write, second_write):
+            self.addCleanup(os.close, write)
+        aggregated = AggregatedEventDevice([first, second])
+        self.addCleanup(aggregated.close)
+        os.write(first_write, pack_frames([[(EV_KEY, 30, 1)], [(EV_KEY, 30, 0)]]))
+        os.write(second_write, pack_frames([[(EV_KEY, 31, 1)]]))
+        events = [aggregated.read_event() for _ in range(3)]
+        self.assertEqual(sorted((path, code, value) for time, type, code, value, path in events),
+                         [(first.path, 30, 0), (first.path, 30, 1), (second.path, 31, 1)])
+        # Events of a device stay in order.
+        self.assertEqual([value for time, type, code, value, path in events if path == first.path], [1, 0])
+        self.assertEqual(aggregated.stats[first.path].as_dict(), {'reads': 1, 'events': 2, 'errors': 0, 'debounced': 0})
+        self.assertEqual(aggregated.stats[second.path].as_dict(), {'reads': 1, 'events': 1, 'errors': 0, 'debounced': 0})
+
+    def test_no_output(self):
+        aggregated = AggregatedEventDevice([])
+        self.addCleanup(aggregated.close)
+        with self.assertRaises(IOError):
+            aggregated.write_event(EV_KEY, 30, 1)
+
+class TestAggregatedHotplug(unittest.TestCase):
+    """ Devices are FIFOs in a temporary directory standing for /dev/input. """
+    def setUp(self):
+        self.now = 0
+        self.directory = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(os.rmdir, self.directory)
+        self.watcher = FakeWatcher()
+        hotplug = DeviceHotplug(lambda path: True, self.directory, watcher=self.watcher, clock=lambda: self.now)
+        self.aggregated = AggregatedEventDevice([], hotplug=hotplug)
+        self.addCleanup(self.aggregated.close)
+
+    def plug(self, name):
+        """ Creates the node, returns a fd to write its events. """
+        path = os.path.join(self.directory, name)
+        os.mkfifo(path)
+        self.addCleanup(os.remove, path)
+        # Opening for reading and writing doesn't wait for the other end.
+        write = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        self.addCleanup(os.close, write)
+        return path, write
+
+    def changes(self, *changes):
+        self.watcher.pending = list(changes)
+        self.aggregated._handle_hotplug(True)
+
+    def test_attach_detach(self):
+        path, write = self.plug('event0')
+        self.changes(('event0', True))
+        self.assertEqual([device.path for device in self.aggregated.devices], [path])
+        os.write(write, pack_frames([[(EV_KEY, 30, 1)]]))
+        self.assertEqual(event_fields([self.aggregated.read_event()]), [(EV_KEY, 30, 1)])
+        # Attached once.
+        self.changes(('event0', True))
+        self.assertEqual(len(self.aggregated.devices), 1)
+        self.changes(('event0', False))
+        self.assertEqual(self.aggregated.devices, [])
+        self.assertEqual(event_fields([self.aggregated.read_event()]), [(EV_KEY, 30, 0)])
+
+    def test_retry(self):
+        path = os.path.join(self.directory, 'event1')
+        self.changes(('event1', True))
+        self.assertEqual(self.aggregated.devices, [])
+        self.assertEqual(self.aggregated.hotplug.timeout(), 0.5)
+        self.now = 0.5
+        self.changes()
+        self.assertEqual(self.aggregated.hotplug.timeout(), 1)
+        self.plug('event1')
+        self.now = 1.5
+        self.changes()
+        self.assertEqual([device.path for device in self.aggregated.devices], [path])
+        self.assertEqual(self.aggregated.hotplug.timeout(), None)
+
+    def test_filtered(self):
+        path, write = self.plug('event0')
+        self.aggregated.scan_codes = [116]
+        with patch.object(_nixcommon, 'describe_device', return_value=device_info(path, [30])):
+            self.changes(('event0', True))
+        self.assertEqual(self.aggregated.devices, [])
+        self.assertEqual(self.aggregated.hotplug.timeout(), None)
+
+MS = 1000000
+PATH = '/dev/input/event-test'
+
+class TestDebouncer(unittest.TestCase):
+    def setUp(self):
+        self.now_ns = 0
+        self.debouncer = Debouncer(0.02, clock_ns=lambda: self.now_ns)
+
+    def event(self, ms, code, value, path=PATH):
+        self.now_ns = ms * MS
+        return (ms * MS, EV_KEY, code, value, path)
+
+    def test_bounces(self):
+        accept = self.debouncer.accept
+        self.assertTrue(accept(self.event(0, 30, 1)))
+        self.assertFalse(accept(self.event(2, 30, 0)))
+        self.assertFalse(accept(self.event(3, 30, 1)))
+        self.assertEqual(self.debouncer.timeout(), None)
+        self.now_ns = 25 * MS
+        self.assertEqual(self.debouncer.flush(), [])
+        self.assertTrue(accept(self.event(40, 30, 0)))
+        self.assertEqual(self.debouncer.suppressed, 2)
+
+    def test_flush_new_state(self):
+        accept = self.debouncer.accept
+        self.assertTrue(accept(self.event(0, 30, 1)))
+        self.assertFalse(accept(self.event(5, 30, 0)))
+        # released for good, emitted when the window ends
+        self.assertAlmostEqual(self.debouncer.timeout(), 0.015)
+        self.now_ns = 19 * MS
+        self.assertEqual(self.debouncer.flush(), [])
+        self.now_ns = 20 * MS
+        self.assertEqual(self.debouncer.flush(), [(20 * MS, EV_KEY, 30, 0, PATH)])
+        self.assertEqual(self.debouncer.flushed, 1)
+        # the flushed release has its own window
+        self.assertFalse(accept(self.event(30, 30, 1)))
+        self.assertTrue(accept(self.event(41, 30, 1)))
+
+    def test_repeats_and_other_keys(self):
+        accept = self.debouncer.accept
+        self.assertTrue(accept(self.event(0, 30, 1)))
+        self.assertTrue(accept(self.event(1, 30, 2)))
+        self.assertTrue(accept(self.event(1, 31, 1)))
+        self.assertTrue(accept(self.event(1, 30, 1, '/dev/input/event-other')))
+
+    def test_windows(self):
+        debouncer = Debouncer(windows={30: 0.02}, clock_ns=lambda: self.now_ns)
+        self.assertTrue(debouncer.accept(self.event(0, 30, 1)))
+        self.assertFalse(debouncer.accept(self.event(1, 30, 0)))
+        self.assertTrue(debouncer.accept(self.event(0, 31, 1)))
+        self.assertTrue(debouncer.accept(self.event(1, 31, 0)))
+
+    def test_forget(self):
+        self.debouncer.accept(self.event(0, 30, 1))
+        self.debouncer.accept(self.event(1, 30, 0))
+        self.debouncer.forget(PATH)
+        self.now_ns = 100 * MS
+        self.assertEqual(self.debouncer.timeout(), None)
+        self.assertEqual(self.debouncer.flush(), [])
+
+def device_info(path, keys=(), repeats=False):
+    capabilities = {EV_KEY: sum(1 << code for code in keys)}
+    if repeats:
+        capabilities[EV_REP] = 0b11
+    return DeviceInfo(path, 'test', '', 0, 0, 0, 0, ('kbd',), capabilities)
+
+class TestDeviceInfo(unittest.TestCase):
+    def test_can_emit(self):
+        info = device_info(PATH, [30, 116])
+        self.assertTrue(info.can_emit([116]))
+        self.assertTrue(info.can_emit({1, 30}))
+        self.assertFalse(info.can_emit([31, 582]))
+        self.assertFalse(info.can_emit([]))
+        # Devices without EV_KEY, like a lid switch.
+        self.assertFalse(DeviceInfo(PATH, 'lid', '', 0, 0, 0, 0, (), {}).can_emit([30]))
+
+    def test_repeats(self):
+        self.assertFalse(device_info(PATH, [30]).repeats)
+        self.assertTrue(device_info(PATH, [30], repeats=True).repeats)
+
+    def test_list_devices_from_proc(self):
+        handlers = {'event0': ['kbd', 'event0'], 'event1': ['kbd', 'event1'],
+                    'event2': ['kbd', 'event2'], 'event3': ['mouse', 'event3']}
+        infos = {'/dev/input/event0': device_info('/dev/input/event0', [30]),
+                 '/dev/input/event1': device_info('/dev/input/event1', [116])}
+        def describe(path, handlers=None):
+            if path not in infos:
+                raise PermissionError(13, 'Permission denied', path)
+            return infos[path]
+        with patch.object(_nixcommon, 'read_proc_handlers', return_value=handlers), \
+                patch.object(_nixcommon, 'describe_device', side_effect=describe):
+            paths = [device.path for device in _nixcommon.list_devices_from_proc('kbd', [116])]
+            # Devices that can't be queried are kept, opening them reports why.
+            self.assertEqual(paths, ['/dev/input/event1', '/dev/input/event2'])
+            paths = [device.path for device in _nixcommon.list_devices_from_proc('kbd')]
+            self.assertEqual(paths, ['/dev/input/event0', '/dev/input/event1', '/dev/input/event2'])
+
+    def test_describe_device_cache(self):
+        with tempfile.NamedTemporaryFile() as f:
+            stat = os.stat(f.name)
+            info = device_info(f.name, [30])
+            _nixcommon._device_info_cache[f.name] = ((stat.st_ino, stat.st_ctime_ns), info)
+            self.addCleanup(_nixcommon.forget_device, f.name)
+            self.assertIs(_nixcommon.describe_device(f.name), info)
+            # A replaced node is queried again, ioctls fail on a regular file.
+            _nixcommon._device_info_cache[f.name] = ((stat.st_ino + 1, stat.st_ctime_ns), info)
+            with self.assertRaises(OSError):
+                _nixcommon.describe_device(f.name, ())
+            _nixcommon._device_info_cache[f.name] = ((stat.st_ino, stat.st_ctime_ns), info)
+            _nixcommon.forget_device(f.name)
+            self.assertNotIn(f.name, _nixcommon._device_info_cache)
+
+if __name__ == '__main__':
+    unittest.main()
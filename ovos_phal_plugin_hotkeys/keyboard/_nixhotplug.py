@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of input devices being plugged in and out, so readers can be
+attached and detached without rescanning or reopening every device.
+"""
+import os
+import re
+import ctypes
+import struct
+from time import monotonic
+from ovos_utils.log import LOG
+
+# Taken from include/uapi/linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+inotify_event_struct = struct.Struct('iIII')
+
+event_node_pattern = re.compile(r'event\d+$')
+
+
+def parse_inotify_events(data):
+    """
+    Returns a list of (name, present) tuples from a read of inotify events,
+    `present` being False for removed entries. Attribute changes are
+    reported as present, since udev fixes the permissions of new nodes after
+    creating them.
+    """
+    changes = []
+    offset = 0
+    while offset + inotify_event_struct.size <= len(data):
+        wd, mask, cookie, length = inotify_event_struct.unpack_from(data, offset)
+        offset += inotify_event_struct.size
+        name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+        offset += length
+        changes.append((name, not mask & (IN_DELETE | IN_MOVED_FROM)))
+    return changes
+
+
+class InotifyWatcher(object):
+    """
+    Watches a directory with inotify, through ctypes to avoid extra
+    dependencies. The file descriptor can be polled with `selectors`.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CREATE | IN_ATTRIB | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, 'inotify_add_watch failed', directory)
+
+    def fileno(self):
+        return self._fd
+
+    def read_changes(self):
+        """ See `parse_inotify_events`. """
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return []
+        return parse_inotify_events(data)
+
+    def timeout(self):
+        return None
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """
+    Stand-in for `InotifyWatcher` where inotify is unavailable, diffing the
+    directory listing every `interval` seconds. Only the listing is read,
+    devices are not reopened.
+    """
+    def __init__(self, directory, interval=2.0, clock=monotonic):
+        self.directory = directory
+        self.interval = interval
+        self.clock = clock
+        self._entries = self._list()
+        self._next_poll = clock() + interval
+
+    def _list(self):
+        try:
+            return set(os.listdir(self.directory))
+        except OSError:
+            return set()
+
+    def fileno(self):
+        return None
+
+    def read_changes(self):
+        now = self.clock()
+        if now < self._next_poll:
+            return []
+        self._next_poll = now + self.interval
+        entries = self._list()
+        changes = [(name, True) for name in entries - self._entries]
+        changes += [(name, False) for name in self._entries - entries]
+        self._entries = entries
+        return changes
+
+    def timeout(self):
+        return max(0, self._next_poll - self.clock())
+
+    def close(self):
+        pass
+
+
+class DeviceHotplug(object):
+    """
+    Tracks `/dev/input/event*` nodes appearing and disappearing, and devices
+    that failed to open, which are retried with exponential backoff.
+
+    - `accept` is called with the path of each new node and decides if it
+    should be attached.
+    - `watcher` defaults to an `InotifyWatcher` of `directory`, or a
+    `PollingWatcher` where inotify is unavailable.
+    """
+    retry_delay = 0.5
+    max_retry_delay = 30.0
+
+    def __init__(self, accept, directory='/dev/input', watcher=None, clock=monotonic):
+        self.accept = accept
+        self.directory = directory
+        self.clock = clock
+        if watcher is None:
+            try:
+                watcher = InotifyWatcher(directory)
+            except (OSError, AttributeError) as e:
+                LOG.warning(f"inotify not available, polling '{directory}' for new devices: {e}")
+                watcher = PollingWatcher(directory, clock=clock)
+        self.watcher = watcher
+        # path -> (attempt, clock time of the next attempt)
+        self._retries = {}
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+    def changes(self, readable=True):
+        """
+        Returns a list of (path, present) for event nodes that changed,
+        including devices whose retry is due. `readable` tells if our file
+        descriptor polled as readable, to avoid needless reads.
+        """
+        changes = []
+        if readable or self.fileno() is None:
+            watcher_changes = self.watcher.read_changes()
+        else:
+            watcher_changes = ()
+        for name, present in watcher_changes:
+            if not event_node_pattern.match(name):
+                continue
+            path = os.path.join(self.directory, name)
+            if not present:
+                self._retries.pop(path, None)
+                changes.append((path, False))
+            elif self.accept(path):
+                changes.append((path, True))
+
+        if self._retries:
+            now = self.clock()
+            for path, (attempt, due) in list(self._retries.items()):
+                if due <= now:
+                    changes.append((path, True))
+        return changes
+
+    def retry_later(self, path):
+        """ Schedules another attempt at attaching `path`, backing off. """
+        attempt = self._retries[path][0] + 1 if path in self._retries else 0
+        delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+        self._retries[path] = (attempt, self.clock() + delay)
+
+    def attached(self, path):
+        self._retries.pop(path, None)
+
+    def timeout(self):
+        """ Seconds until `changes` has something to do without fd activity. """
+        now = self.clock()
+        timeouts = [max(0, due - now) for attempt, due in self._retries.values()]
+        watcher_timeout = self.watcher.timeout()
+        if watcher_timeout is not None:
+            timeouts.append(watcher_timeout)
+        return min(timeouts) if timeouts else None
+
+    def close(self):
+        self.watcher.close()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+from ._nixhotplug import DeviceHotplug, PollingWatcher, parse_inotify_events, inotify_event_struct, IN_ATTRIB, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO
+
+"""
+Tests of device hotplug detection, with a fake watcher and clock instead of
+inotify and real devices.
+"""
+
+class FakeWatcher(object):
+    def __init__(self):
+        self.pending = []
+
+    def fileno(self):
+        return None
+
+    def read_changes(self):
+        changes, self.pending = self.pending, []
+        return changes
+
+    def timeout(self):
+        return None
+
+    def close(self):
+        pass
+
+def inotify_event(mask, name):
+    # Names are padded with NULs to align the next record.
+    name = name.encode() + b'\0' * (16 - len(name))
+    return inotify_event_struct.pack(1, mask, 0, len(name)) + name
+
+class TestParseInotifyEvents(unittest.TestCase):
+    def test_events(self):
+        data = b''.join(inotify_event(mask, name) for mask, name in [
+            (IN_CREATE, 'event3'), (IN_ATTRIB, 'event3'), (IN_MOVED_TO, 'event4'),
+            (IN_DELETE, 'event3'), (IN_MOVED_FROM, 'mouse0')])
+        self.assertEqual(parse_inotify_events(data), [
+            ('event3', True), ('event3', True), ('event4', True), ('event3', False), ('mouse0', False)])
+
+    def test_truncated(self):
+        data = inotify_event(IN_CREATE, 'event3') + inotify_event(IN_CREATE, 'event4')[:8]
+        self.assertEqual(parse_inotify_events(data), [('event3', True)])
+
+class TestPollingWatcher(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.directory)
+        self.touch('event0')
+        self.watcher = PollingWatcher(self.directory, interval=2.0, clock=lambda: self.now)
+
+    def touch(self, name):
+        path = os.path.join(self.directory, name)
+        open(path, 'w').close()
+        self.addCleanup(lambda: os.path.exists(path) and os.remove(path))
+
+    def test_diff(self):
+        self.touch('event1')
+        os.remove(os.path.join(self.directory, 'event0'))
+        # Nothing until the next poll.
+        self.assertEqual(self.watcher.read_changes(), [])
+        self.assertEqual(self.watcher.timeout(), 2.0)
+        self.now = 2.0
+        self.assertEqual(sorted(self.watcher.read_changes()), [('event0', False), ('event1', True)])
+        self.assertEqual(self.watcher.timeout(), 2.0)
+        self.now = 4.0
+        self.assertEqual(self.watcher.read_changes(), [])
+
+class TestDeviceHotplug(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.watcher = FakeWatcher()
+        self.rejected = set()
+        self.hotplug = DeviceHotplug(lambda path: path not in self.rejected, '/dev/input',
+                                     watcher=self.watcher, clock=lambda: self.now)
+
+    def test_changes(self):
+        self.rejected.add('/dev/input/event2')
+        self.watcher.pending = [('event1', True), ('event2', True), ('mouse0', True),
+                                ('by-id', True), ('event3', False)]
+        self.assertEqual(self.hotplug.changes(), [('/dev/input/event1', True), ('/dev/input/event3', False)])
+        self.assertEqual(self.hotplug.timeout(), None)
+
+    def test_retry_backoff(self):
+        path = '/dev/input/event1'
+        delays = []
+        for attempt in range(9):
+            self.hotplug.retry_later(path)
+            delays.append(self.hotplug.timeout())
+            self.assertEqual(self.hotplug.changes(), [])
+            self.now += delays[-1]
+            self.assertEqual(self.hotplug.changes(), [(path, True)])
+        self.assertEqual(delays, [0.5, 1, 2, 4, 8, 16, 30, 30, 30])
+        self.hotplug.attached(path)
+        self.assertEqual(self.hotplug.changes(), [])
+        self.assertEqual(self.hotplug.timeout(), None)
+        # Backing off starts over.
+        self.hotplug.retry_later(path)
+        self.assertEqual(self.hotplug.timeout(), 0.5)
+
+    def test_removed_while_retrying(self):
+        self.hotplug.retry_later('/dev/input/event1')
+        self.watcher.pending = [('event1', False)]
+        self.now = 1
+        self.assertEqual(self.hotplug.changes(), [('/dev/input/event1', False)])
+        self.assertEqual(self.hotplug.changes(), [])
+        self.assertEqual(self.hotplug.timeout(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,18 +6,21 @@ have a list of names and vice-versa.
 """
 import re
 import subprocess
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 from ovos_utils.log import LOG
 from subprocess import check_output
 
 from ._canonical_names import all_modifiers, normalize_name, canonical_names
-from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP
-from ._nixcommon import EV_KEY, aggregate_devices
+from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP, KEY_HOLD
+from ._nixcommon import EV_KEY, Debouncer, aggregate_devices, device_repeats
 from ._xk_keysyms import XK_KEYSYM_SYMBOLS
 
 
-# TODO: start by reading current keyboard state, as to not missing any already pressed keys.
-# See: http://stackoverflow.com/questions/3649874/how-to-get-keyboard-state-in-linux
+# Keys already pressed when a device is attached, and key transitions lost
+# when the kernel drops events (SYN_DROPPED), are synthesized by the devices
+# from the EVIOCGKEY state. See `EventDevice.resync`.
 
 def cleanup_key(name):
     """ Formats a dumpkeys format to our standard. """
@@ -138,12 +141,107 @@ def build_tables():
 
 
 device = None
+# Scan codes to read from the kernel, None for all keys.
+key_filter = None
+# Debouncer applied to all devices, None to disable.
+debouncer = None
+# Scan codes of registered hotkeys, to enable in the virtual keyboard.
+output_codes = set()
 
 
 def build_device():
     global device
     if device: return
-    device = aggregate_devices('kbd')
+    device = aggregate_devices('kbd', scan_codes=key_filter, output_key_codes=layout_scan_codes)
+    if hasattr(device, 'set_event_mask'):
+        device.set_event_mask((EV_KEY,), key_filter)
+    if hasattr(device, 'set_debounce'):
+        device.set_debounce(debouncer)
+
+
+def layout_scan_codes():
+    """
+    Scan codes to enable in the virtual keyboard: the keyboard layout, the
+    keys read and the keys of registered hotkeys, see `add_output_codes`.
+    """
+    build_tables()
+    scan_codes = set(scan_code for scan_code, modifiers in to_name) or set(range(1, 256))
+    return scan_codes | (key_filter or set()) | output_codes
+
+
+def add_output_codes(scan_codes):
+    """ Enables keys in the virtual keyboard, before it is created if possible. """
+    output_codes.update(scan_codes)
+
+
+def close_output():
+    if hasattr(device, 'close_output'):
+        device.close_output()
+
+
+def set_key_filter(scan_codes):
+    global key_filter
+    key_filter = None if scan_codes is None else set(scan_codes)
+    if hasattr(device, 'set_event_mask'):
+        device.set_event_mask((EV_KEY,), key_filter)
+
+
+def set_debounce(window, windows=None):
+    global debouncer
+    debouncer = Debouncer(window, windows) if window or windows else None
+    if hasattr(device, 'set_debounce'):
+        device.set_debounce(debouncer)
+
+
+def device_stats():
+    if not hasattr(device, 'stats'):
+        return {}
+    return {path: stats.as_dict() for path, stats in list(device.stats.items())}
+
+
+# Software autorepeat as (delay, interval, scheduler), see `set_autorepeat`.
+autorepeat = None
+# (device_id, scan_code) -> [ScheduledCall] of each key being repeated, the
+# list identifies the press so a late call can't repeat the next one.
+_repeating = {}
+# Serializes callbacks from the listening thread and the repeats.
+_callback_lock = threading.Lock()
+
+
+def set_autorepeat(delay, interval, scheduler):
+    """
+    Synthesizes KEY_HOLD events for keys held on devices without kernel
+    autorepeat, like most gpio buttons, first after `delay` seconds and then
+    every `interval`. A `delay` of None disables it.
+    """
+    global autorepeat
+    with _callback_lock:
+        autorepeat = None if delay is None else (delay, interval, scheduler)
+        for press in _repeating.values():
+            press[0].cancel()
+        _repeating.clear()
+
+
+def _repeat(callback, key, press):
+    with _callback_lock:
+        if _repeating.get(key) is not press:
+            return  # released meanwhile
+        delay, interval, scheduler = autorepeat
+        press[0] = scheduler.call_later(interval, _repeat, (callback, key, press))
+        device_id, scan_code = key
+        callback(make_event(KEY_HOLD, scan_code, device_id))
+
+
+def _track_repeat(callback, event):
+    key = (event.device, event.scan_code)
+    if event.event_type == KEY_UP:
+        press = _repeating.pop(key, None)
+        if press is not None:
+            press[0].cancel()
+    elif event.event_type == KEY_DOWN and key not in _repeating and not device_repeats(event.device):
+        delay, interval, scheduler = autorepeat
+        press = _repeating[key] = [None]
+        press[0] = scheduler.call_later(delay, _repeat, (callback, key, press))
 
 
 def init():
@@ -154,34 +252,82 @@ def init():
 pressed_modifiers = set()
 
 
+def make_event(event_type, scan_code, device_id, time_ns=None):
+    pressed_modifiers_tuple = tuple(sorted(pressed_modifiers))
+    names = to_name[(scan_code, pressed_modifiers_tuple)] or to_name[(scan_code, ())] or ['unknown']
+    name = names[0]
+
+    if name in all_modifiers:
+        if event_type == KEY_DOWN:
+            pressed_modifiers.add(name)
+        elif event_type == KEY_UP:
+            pressed_modifiers.discard(name)
+
+    is_keypad = scan_code in keypad_scan_codes
+    return KeyboardEvent(event_type=event_type, scan_code=scan_code, name=name, time_ns=time_ns, device=device_id,
+                         is_keypad=is_keypad, modifiers=pressed_modifiers_tuple)
+
+
 def listen(callback):
     build_device()
     build_tables()
 
     while True:
-        time, type, code, value, device_id = device.read_event()
+        time_ns, type, code, value, device_id = device.read_event()
         if type != EV_KEY:
             continue
 
-        scan_code = code
-        event_type = KEY_DOWN if value else KEY_UP  # 0 = UP, 1 = DOWN, 2 = HOLD
-
-        pressed_modifiers_tuple = tuple(sorted(pressed_modifiers))
-        names = to_name[(scan_code, pressed_modifiers_tuple)] or to_name[(scan_code, ())] or ['unknown']
-        name = names[0]
+        # 0 = UP, 1 = DOWN, 2 = HOLD
+        event_type = KEY_UP if value == 0 else KEY_DOWN if value == 1 else KEY_HOLD
+        with _callback_lock:
+            event = make_event(event_type, code, device_id, time_ns)
+            if autorepeat is not None:
+                _track_repeat(callback, event)
+            callback(event)
+
+
+# Writes collected by `batch`, per thread.
+_batch = threading.local()
+
+
+@contextmanager
+def batch():
+    """
+    Collects the key events written in this block, and writes them all with
+    a single syscall when the outermost block exits. Events are grouped in
+    frames delimited by `sync`, each one seen atomically by other programs.
+    """
+    depth = getattr(_batch, 'depth', 0)
+    if not depth:
+        _batch.frames = [[]]
+    _batch.depth = depth + 1
+    try:
+        yield
+    finally:
+        _batch.depth = depth
+        if not depth:
+            frames = [frame for frame in _batch.frames if frame]
+            _batch.frames = None
+            if frames:
+                build_device()
+                device.write_events(frames)
 
-        if name in all_modifiers:
-            if event_type == KEY_DOWN:
-                pressed_modifiers.add(name)
-            else:
-                pressed_modifiers.discard(name)
 
-        is_keypad = scan_code in keypad_scan_codes
-        callback(KeyboardEvent(event_type=event_type, scan_code=scan_code, name=name, time=time, device=device_id,
-                               is_keypad=is_keypad, modifiers=pressed_modifiers_tuple))
+def sync():
+    """ Ends the current frame of the batch, if any. """
+    frames = getattr(_batch, 'frames', None)
+    if frames and frames[-1]:
+        frames.append([])
 
 
 def write_event(scan_code, is_down):
+    frames = getattr(_batch, 'frames', None)
+    if frames is not None:
+        # A key can only change once per frame.
+        if any(code == scan_code for type, code, value in frames[-1]):
+            frames.append([])
+        frames[-1].append((EV_KEY, scan_code, int(is_down)))
+        return
     build_device()
     device.write_event(EV_KEY, scan_code, int(is_down))
 
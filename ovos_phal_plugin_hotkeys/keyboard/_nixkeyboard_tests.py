@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import Mock, patch
+
+from . import _nixcommon, _nixkeyboard
+from ._keyboard_event import KEY_DOWN, KEY_UP, KEY_HOLD
+from ._nixcommon_tests import device_info
+from ._scheduler import Scheduler
+
+"""
+Tests of the Linux keyboard backend without real devices, the software
+autorepeat runs on a scheduler with a fake clock instead of its thread.
+"""
+
+PATH = '/dev/input/event-test'
+
+class TestAutorepeat(unittest.TestCase):
+    def setUp(self):
+        self.ms = 0
+        self.scheduler = Scheduler(clock=lambda: self.ms / 1000, threaded=False)
+        _nixkeyboard.set_autorepeat(0.5, 0.1, self.scheduler)
+        self.addCleanup(_nixkeyboard.set_autorepeat, None, None, None)
+        # Devices without kernel autorepeat, like gpio buttons.
+        self.repeats = set()
+        patcher = patch.object(_nixkeyboard, 'device_repeats', lambda path: path in self.repeats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.events = []
+
+    def key(self, event_type, scan_code=30, path=PATH):
+        event = _nixkeyboard.make_event(event_type, scan_code, path)
+        _nixkeyboard._track_repeat(self.events.append, event)
+
+    def advance(self, ms):
+        self.ms += ms
+        self.scheduler.run_due()
+
+    def holds(self):
+        return [(event.scan_code, event.device) for event in self.events if event.event_type == KEY_HOLD]
+
+    def test_delay(self):
+        self.key(KEY_DOWN)
+        self.advance(499)
+        self.assertEqual(self.holds(), [])
+        self.advance(2)
+        self.assertEqual(self.holds(), [(30, PATH)])
+
+    def test_interval(self):
+        self.key(KEY_DOWN)
+        self.advance(501)
+        self.advance(98)
+        self.assertEqual(len(self.holds()), 1)
+        self.advance(2)
+        self.assertEqual(len(self.holds()), 2)
+        self.advance(100)
+        self.assertEqual(len(self.holds()), 3)
+
+    def test_cancelled_on_release(self):
+        self.key(KEY_DOWN)
+        self.advance(501)
+        self.key(KEY_UP)
+        self.advance(1000)
+        self.assertEqual(len(self.holds()), 1)
+        self.assertEqual(len(self.scheduler), 0)
+        # Released before the delay.
+        self.key(KEY_DOWN)
+        self.advance(400)
+        self.key(KEY_UP)
+        self.advance(1000)
+        self.assertEqual(len(self.holds()), 1)
+
+    def test_per_device(self):
+        self.key(KEY_DOWN)
+        self.key(KEY_DOWN, path='/dev/input/event-other')
+        self.advance(501)
+        self.key(KEY_UP)
+        self.advance(100)
+        self.assertEqual(self.holds(), [(30, PATH), (30, '/dev/input/event-other'), (30, '/dev/input/event-other')])
+
+    def test_kernel_repeats(self):
+        self.repeats.add(PATH)
+        self.key(KEY_DOWN)
+        self.advance(1000)
+        self.assertEqual(self.holds(), [])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_disabled(self):
+        self.key(KEY_DOWN)
+        _nixkeyboard.set_autorepeat(None, None, None)
+        self.advance(1000)
+        self.assertEqual(self.holds(), [])
+
+class TestDeviceRepeats(unittest.TestCase):
+    def test_cached(self):
+        self.addCleanup(_nixcommon.forget_device, PATH)
+        info = device_info(PATH, [30], repeats=True)
+        with patch.object(_nixcommon, 'describe_device', return_value=info) as describe_device:
+            self.assertTrue(_nixcommon.device_repeats(PATH))
+            self.assertTrue(_nixcommon.device_repeats(PATH))
+            self.assertEqual(describe_device.call_count, 1)
+            # Until the device is unplugged.
+            _nixcommon.forget_device(PATH)
+            describe_device.return_value = device_info(PATH, [30])
+            self.assertFalse(_nixcommon.device_repeats(PATH))
+
+    def test_unknown(self):
+        self.addCleanup(_nixcommon.forget_device, PATH)
+        with patch.object(_nixcommon, 'describe_device', side_effect=FileNotFoundError):
+            self.assertTrue(_nixcommon.device_repeats(PATH))
+
+class TestDeviceStats(unittest.TestCase):
+    def test_device_stats(self):
+        aggregated = Mock(stats={PATH: _nixcommon.DeviceStats()})
+        aggregated.stats[PATH].events = 2
+        with patch.object(_nixkeyboard, 'device', aggregated):
+            self.assertEqual(_nixkeyboard.device_stats(), {PATH: {'reads': 0, 'events': 2, 'errors': 0, 'debounced': 0}})
+        with patch.object(_nixkeyboard, 'device', None):
+            self.assertEqual(_nixkeyboard.device_stats(), {})
+
+if __name__ == '__main__':
+    unittest.main()
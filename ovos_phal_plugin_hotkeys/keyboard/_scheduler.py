@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from threading import Thread, Condition
+from time import monotonic
+import itertools
+import heapq
+import traceback
+
+class ScheduledCall(object):
+    """ Handle of a call made by `Scheduler`, see `cancel`. """
+    __slots__ = ('scheduler', 'when', 'fn', 'args', 'cancelled')
+
+    def __init__(self, scheduler, when, fn, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """ Prevents the call if it didn't happen yet, in amortized constant time. """
+        self.scheduler.cancel(self)
+
+class Scheduler(object):
+    """
+    Runs timed calls from a single thread, started on first use, keeping them
+    in a heap ordered by due time. Cancelled calls are left in the heap and
+    skipped, the heap is rebuilt when they are the majority.
+
+    - `clock` returns the current time in seconds, `time.monotonic` by default.
+    - `threaded` if false no thread is started, and due calls only happen when
+    `run_due` is called. Together with a fake `clock` this makes tests
+    deterministic.
+    """
+    def __init__(self, clock=monotonic, threaded=True):
+        self.clock = clock
+        self.threaded = threaded
+        self.thread = None
+        self._heap = []
+        self._cancelled = 0
+        self._counter = itertools.count()
+        self._condition = Condition()
+
+    def call_at(self, when, fn, args=()):
+        """ Calls `fn(*args)` when `clock()` reaches `when`, returns a `ScheduledCall`. """
+        call = ScheduledCall(self, when, fn, args)
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), call))
+            if self.threaded and self.thread is None:
+                self.thread = Thread(target=self._run, name='keyboard scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+            # Only wake up the thread if it's waiting for a later call.
+            if self._heap[0][2] is call:
+                self._condition.notify()
+        return call
+
+    def call_later(self, delay, fn, args=()):
+        """ Calls `fn(*args)` after `delay` seconds, returns a `ScheduledCall`. """
+        return self.call_at(self.clock() + delay, fn, args)
+
+    def cancel(self, call):
+        with self._condition:
+            if not call.cancelled:
+                call.cancelled = True
+                call.fn = call.args = None
+                self._cancelled += 1
+                if self._cancelled > len(self._heap) // 2:
+                    self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                    heapq.heapify(self._heap)
+                    self._cancelled = 0
+
+    def _pop_due(self):
+        """
+        Returns the next call due as a (fn, args) tuple, or the seconds until
+        one is (None for never). Must be called with the lock held.
+        """
+        while self._heap:
+            when, _, call = self._heap[0]
+            if call.cancelled:
+                heapq.heappop(self._heap)
+                self._cancelled = max(0, self._cancelled - 1)
+                continue
+            delay = when - self.clock()
+            if delay > 0:
+                return delay
+            heapq.heappop(self._heap)
+            fn, args = call.fn, call.args
+            # Out of the heap, cancelling it now is a no-op.
+            call.cancelled = True
+            call.fn = call.args = None
+            return fn, args
+        return None
+
+    @staticmethod
+    def _invoke(fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def run_due(self):
+        """ Makes all calls that are due, returning how many were made. """
+        count = 0
+        while True:
+            with self._condition:
+                due = self._pop_due()
+            if not isinstance(due, tuple):
+                return count
+            self._invoke(*due)
+            count += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._pop_due()
+                while not isinstance(due, tuple):
+                    self._condition.wait(due)
+                    due = self._pop_due()
+            self._invoke(*due)
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
@@ -0,0 +1,26 @@
+import unittest
+
+from ovos_phal_plugin_hotkeys.keyboard._scheduler import Scheduler
+
+
+class FakeClock:
+    """a clock advanced by hand, in milliseconds"""
+
+    def __init__(self):
+        self.ms = 0
+
+    def __call__(self):
+        return self.ms / 1000
+
+
+class ScheduledTestCase(unittest.TestCase):
+    """tests with a scheduler without thread, on a FakeClock moved by advance()"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = Scheduler(clock=self.clock, threaded=False)
+
+    def advance(self, ms):
+        """move the clock and make the calls due by then"""
+        self.clock.ms += ms
+        self.scheduler.run_due()
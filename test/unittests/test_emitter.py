@@ -0,0 +1,234 @@
+import unittest
+
+from ovos_phal_plugin_hotkeys.emitter import EmitThrottle, EmitWorker, OfflineBuffer
+
+from fake_clock import ScheduledTestCase
+
+
+class TestEmitThrottle(ScheduledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sent = []
+        self.throttle = EmitThrottle(lambda *args: self.sent.append(args), self.scheduler)
+
+    def test_no_policy(self):
+        self.throttle.trigger("a", {"seq": 1})
+        self.throttle.trigger("a", {"seq": 2})
+        self.assertEqual(self.sent, [("a", None, {"seq": 1}), ("a", None, {"seq": 2})])
+
+    def test_leading(self):
+        self.throttle.add("a", "leading", 250)
+        self.throttle.trigger("a")
+        self.advance(100)
+        self.throttle.trigger("a")
+        self.advance(151)
+        self.throttle.trigger("a")
+        self.assertEqual(self.sent, [("a", None, None), ("a", None, None)])
+        self.assertEqual(self.throttle.dropped(), {"a": 1})
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_coalesce(self):
+        self.throttle.add("a", "coalesce", 250)
+        self.throttle.trigger("a", {"seq": 1})
+        for seq in (2, 3, 4):
+            self.advance(50)
+            self.throttle.trigger("a", {"seq": seq})
+        self.assertEqual(self.sent, [("a", None, {"seq": 1})])
+        self.advance(101)
+        # the count of the coalesced triggers with the context of the last one
+        self.assertEqual(self.sent[1:], [("a", {"count": 3}, {"seq": 4})])
+        # a new window started with the flush
+        self.throttle.trigger("a", {"seq": 5})
+        self.advance(251)
+        self.assertEqual(self.sent[2:], [("a", {"count": 1}, {"seq": 5})])
+
+    def test_token_bucket(self):
+        self.throttle.add("a", rate=2, burst=2)
+        for _ in range(3):
+            self.throttle.trigger("a")
+        self.assertEqual(len(self.sent), 2)
+        self.advance(499)
+        self.throttle.trigger("a")
+        self.assertEqual(len(self.sent), 2)
+        self.advance(2)
+        self.throttle.trigger("a")
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.throttle.dropped(), {"a": 2})
+
+    def test_coalesce_waits_for_token(self):
+        self.throttle.add("a", "coalesce", 100, rate=1)
+        self.throttle.trigger("a")
+        self.advance(50)
+        self.throttle.trigger("a")
+        self.advance(51)
+        # the window ended but the bucket is empty until 1s
+        self.assertEqual(len(self.sent), 1)
+        self.advance(900)
+        self.assertEqual(self.sent[1:], [("a", {"count": 1}, None)])
+        self.assertEqual(self.throttle.dropped(), {"a": 0})
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            self.throttle.add("a", "trailing")
+        with self.assertRaises(ValueError):
+            self.throttle.add("a", rate=0)
+        with self.assertRaises(ValueError):
+            self.throttle.add("a", rate=1, burst=0)
+
+    def test_clear(self):
+        self.throttle.add("a", "coalesce", 250)
+        self.throttle.trigger("a")
+        self.throttle.trigger("a")
+        self.throttle.clear()
+        self.advance(1000)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(self.scheduler), 0)
+
+
+class TestEmitWorker(ScheduledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sent = []
+        self.worker = EmitWorker(self.send, maxsize=2, clock=self.clock, threaded=False)
+
+    def send(self, msg_type, data=None, context=None):
+        if msg_type == "fail":
+            raise ConnectionError("bus down")
+        self.sent.append((msg_type, data))
+
+    def test_send(self):
+        self.worker.put("a")
+        self.worker.put("b", {"count": 2})
+        self.assertEqual(self.sent, [])
+        self.worker.run_pending()
+        self.assertEqual(self.sent, [("a", None), ("b", {"count": 2})])
+        self.assertEqual(self.worker.stats()["sent"], 2)
+
+    def test_latency(self):
+        self.worker.put("a")
+        self.clock.ms += 30
+        self.worker.put("b")
+        self.clock.ms += 10
+        self.worker.run_pending()
+        stats = self.worker.stats()
+        self.assertAlmostEqual(stats["latency_max_ms"], 40)
+        self.assertAlmostEqual(stats["latency_avg_ms"], 25)
+
+    def test_drop_oldest(self):
+        for msg_type in "abc":
+            self.worker.put(msg_type)
+        self.worker.run_pending()
+        self.assertEqual(self.sent, [("b", None), ("c", None)])
+        self.assertEqual(self.worker.stats()["dropped"], 1)
+
+    def test_drop_newest(self):
+        self.worker.configure(2, "drop_newest")
+        for msg_type in "abc":
+            self.worker.put(msg_type)
+        self.worker.run_pending()
+        self.assertEqual(self.sent, [("a", None), ("b", None)])
+        self.assertEqual(self.worker.stats()["dropped"], 1)
+
+    def test_coalesce(self):
+        self.worker.configure(2, "coalesce")
+        self.worker.put("a")
+        self.worker.put("b")
+        self.worker.put("a", {"count": 3})
+        # no queued "c" to merge with, the oldest is dropped
+        self.worker.put("c")
+        self.worker.run_pending()
+        self.assertEqual(self.sent, [("b", None), ("c", None)])
+        stats = self.worker.stats()
+        self.assertEqual((stats["coalesced"], stats["dropped"]), (1, 1))
+
+    def test_coalesce_merges_count(self):
+        self.worker.configure(2, "coalesce")
+        self.worker.put("a")
+        self.worker.put("b")
+        self.worker.put("a", {"count": 3})
+        self.worker.run_pending()
+        self.assertEqual(self.sent, [("a", {"count": 4}), ("b", None)])
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            self.worker.configure(2, "block")
+        self.assertEqual(self.worker.overflow_policy, "drop_oldest")
+
+    def test_failed(self):
+        self.worker.put("fail")
+        self.worker.put("a")
+        self.worker.run_pending()
+        self.assertEqual(self.sent, [("a", None)])
+        self.assertEqual(self.worker.stats()["failed"], 1)
+
+    def test_closed(self):
+        self.worker.close()
+        self.worker.put("a")
+        self.worker.run_pending()
+        self.assertEqual(self.sent, [])
+
+    def test_threaded(self):
+        worker = EmitWorker(self.send)
+        worker.put("a")
+        worker.close()
+        self.assertEqual(self.sent, [("a", None)])
+
+
+class TestOfflineBuffer(ScheduledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sent = []
+        self.offline = OfflineBuffer(3, self.clock)
+        self.offline.set_ttl("listen", 1000)
+        self.worker = EmitWorker(lambda *args: self.sent.append(args), clock=self.clock,
+                                 threaded=False)
+        self.worker.offline = self.offline
+
+    def test_held_while_disconnected(self):
+        self.worker.disconnected()
+        self.worker.put("a", None, {"seq": 1})
+        self.worker.run_pending()
+        self.assertEqual((self.sent, len(self.offline)), ([], 1))
+        self.worker.put("b")
+        self.worker.reconnected()
+        self.worker.put("c")
+        self.worker.run_pending()
+        # held messages go first, in order
+        self.assertEqual([args[0] for args in self.sent], ["a", "b", "c"])
+        self.assertEqual(self.sent[0], ("a", None, {"seq": 1}))
+
+    def test_ttl(self):
+        self.worker.disconnected()
+        self.worker.put("listen")
+        self.worker.put("stop")
+        self.clock.ms += 500
+        self.worker.put("listen")
+        self.worker.run_pending()
+        self.clock.ms += 501
+        self.worker.reconnected()
+        self.worker.run_pending()
+        # the first listen is stale, messages without a ttl never are
+        self.assertEqual([args[0] for args in self.sent], ["stop", "listen"])
+        self.assertEqual(self.worker.stats()["offline_expired"], 1)
+
+    def test_ring(self):
+        self.worker.disconnected()
+        for msg_type in "abcd":
+            self.worker.put(msg_type)
+        self.worker.run_pending()
+        self.worker.reconnected()
+        self.worker.run_pending()
+        self.assertEqual([args[0] for args in self.sent], ["b", "c", "d"])
+        self.assertEqual(self.worker.stats()["offline_dropped"], 1)
+
+    def test_without_buffer(self):
+        # without a buffer the bus client gets them regardless
+        self.worker.offline = None
+        self.worker.disconnected()
+        self.worker.put("a")
+        self.worker.run_pending()
+        self.assertEqual(len(self.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import unittest
+
+from ovos_phal_plugin_hotkeys.gestures import HoldDetector, RepeatLimiter, TapCounter
+
+from fake_clock import ScheduledTestCase
+
+
+class TestHoldDetector(ScheduledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.holds = HoldDetector(lambda *args: self.calls.append(args), self.scheduler)
+        self.holds.add(30, "long", 1000)
+        self.holds.add(30, "short", 500)
+
+    def test_thresholds(self):
+        self.holds.press(30, "press")
+        self.advance(499)
+        self.assertEqual(self.calls, [])
+        self.advance(2)
+        self.assertEqual(self.calls, [("short", "press")])
+        self.advance(500)
+        self.assertEqual(self.calls, [("short", "press"), ("long", "press")])
+        self.assertTrue(self.holds.release(30))
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_released_before(self):
+        self.holds.press(30)
+        self.advance(400)
+        self.assertFalse(self.holds.release(30))
+        self.advance(1000)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_repeated_press_ignored(self):
+        self.holds.press(30, "first")
+        self.advance(300)
+        self.holds.press(30, "repeat")
+        self.advance(201)
+        self.assertEqual(self.calls, [("short", "first")])
+
+    def test_next_press_restarts(self):
+        self.holds.press(30)
+        self.advance(600)
+        self.assertTrue(self.holds.release(30))
+        self.holds.press(30, "again")
+        self.advance(400)
+        self.assertEqual(self.calls, [("short", None)])
+        self.advance(101)
+        self.assertEqual(self.calls, [("short", None), ("short", "again")])
+
+    def test_unmapped_key(self):
+        self.holds.press(31)
+        self.assertFalse(self.holds.release(31))
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_clear(self):
+        self.holds.press(30)
+        self.holds.clear()
+        self.advance(2000)
+        self.assertEqual(self.calls, [])
+
+
+class TestTapCounter(ScheduledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.taps = TapCounter(lambda *args: self.calls.append(("taps",) + args),
+                               lambda *args: self.calls.append(("single",) + args),
+                               self.scheduler)
+        self.taps.add(48, "double", 2, 300)
+
+    def tap(self, event, hold_ms=50):
+        self.assertTrue(self.taps.press(48, event))
+        self.advance(hold_ms)
+        return self.taps.release(48)
+
+    def test_double_tap(self):
+        self.assertTrue(self.tap("first"))
+        self.advance(100)
+        self.assertTrue(self.taps.press(48, "second"))
+        # resolved right away, the highest mapped count
+        self.assertEqual(self.calls, [("taps", ["double"], "second")])
+        self.advance(50)
+        self.assertTrue(self.taps.release(48))
+        self.advance(1000)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_single_tap(self):
+        self.assertTrue(self.tap("first"))
+        self.advance(249)
+        self.assertEqual(self.calls, [])
+        self.advance(2)
+        self.assertEqual(self.calls, [("single", 48, 1, True, ["first"])])
+
+    def test_single_tap_held(self):
+        self.assertTrue(self.taps.press(48, "first"))
+        self.advance(301)
+        self.assertEqual(self.calls, [("single", 48, 1, False, ["first"])])
+        # the release goes through the plain mappings
+        self.assertFalse(self.taps.release(48))
+
+    def test_repeat_while_held(self):
+        self.assertTrue(self.taps.press(48, "first"))
+        self.advance(100)
+        self.assertTrue(self.taps.press(48, "repeat"))
+        self.advance(301)
+        self.assertEqual(self.calls, [("single", 48, 1, False, ["first"])])
+
+    def test_window_restarts(self):
+        self.taps.add(48, "triple", 3, 300)
+        self.tap("first")
+        self.advance(200)
+        self.tap("second")
+        self.advance(200)
+        # 500ms after the first press, 250ms after the second one
+        self.assertEqual(self.calls, [])
+        self.tap("third")
+        self.assertEqual(self.calls, [("taps", ["triple"], "third")])
+
+    def test_triple_tap(self):
+        self.taps.add(48, "triple", 3, 300)
+        self.tap("first")
+        self.tap("second")
+        self.advance(301)
+        self.assertEqual(self.calls, [("taps", ["double"], "second")])
+        self.calls.clear()
+        self.tap(1)
+        self.tap(2)
+        self.tap(3)
+        self.assertEqual(self.calls, [("taps", ["triple"], 3)])
+
+    def test_unmapped_key(self):
+        self.assertFalse(self.taps.press(30))
+        self.assertFalse(self.taps.release(30))
+
+    def test_clear(self):
+        self.tap("first")
+        self.taps.clear()
+        self.advance(1000)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(len(self.scheduler), 0)
+
+
+class TestRepeatLimiter(ScheduledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.repeats = RepeatLimiter(self.clock)
+        self.repeats.add(30, "pass", "pass")
+        self.repeats.add(30, "ignore", "ignore")
+        self.repeats.add(30, "throttled", 2)
+
+    def test_policies(self):
+        self.repeats.press(30)
+        self.advance(100)
+        self.assertEqual(self.repeats.repeat(30), ["pass"])
+        self.advance(401)
+        self.assertEqual(self.repeats.repeat(30), ["pass", "throttled"])
+        self.advance(100)
+        self.assertEqual(self.repeats.repeat(30), ["pass"])
+
+    def test_wants_repeats(self):
+        self.assertTrue(self.repeats.wants_repeats(30))
+        self.repeats.add(31, "ignore", "ignore")
+        self.assertFalse(self.repeats.wants_repeats(31))
+        self.assertFalse(self.repeats.wants_repeats(32))
+
+    def test_invalid_policy(self):
+        for policy in ("often", 0, -1, True):
+            with self.assertRaises(ValueError):
+                self.repeats.add(30, "invalid", policy)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from ovos_bus_client.message import Message
+from ovos_utils.fakebus import FakeBus
+
+from ovos_phal_plugin_hotkeys import HotKeysPlugin
+from ovos_phal_plugin_hotkeys.keyboard import KEY_DOWN, KEY_HOLD, KEY_UP, KeyboardEvent
+
+
+class _Plugin(HotKeysPlugin):
+    """the plugin without its keyboard thread"""
+
+    def run(self):
+        pass
+
+
+class _PluginTest(unittest.TestCase):
+    config = {}
+
+    def setUp(self):
+        # the keyboard listener is never started
+        for name in ("unhook_all_hotkeys", "close_output"):
+            patcher = patch(f"ovos_phal_plugin_hotkeys.keyboard.{name}")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.bus = FakeBus()
+        self.sent = []
+        self.bus.on("test.hotkey", self.sent.append)
+        self.plugin = _Plugin(bus=self.bus, config=dict(self.config, filter_keys=False))
+
+    def tearDown(self):
+        self.plugin.shutdown()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 1
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+
+class TestBusConnection(_PluginTest):
+    config = {"offline_buffer_size": 4}
+
+    def test_down_events(self):
+        for event in ("close", "reconnecting", "error"):
+            self.bus.emit(Message("open"))
+            self.assertTrue(self.plugin.worker.online)
+            self.bus.emit(Message(event))
+            self.assertFalse(self.plugin.worker.online)
+
+    def test_held_until_open(self):
+        self.bus.emit(Message("close"))
+        self.plugin.emit("test.hotkey")
+        self.wait_for(lambda: len(self.plugin.worker.offline) == 1)
+        self.assertEqual(self.sent, [])
+        self.bus.emit(Message("open"))
+        self.wait_for(lambda: len(self.sent) == 1)
+        self.assertEqual(self.sent[0].msg_type, "test.hotkey")
+
+    def test_shutdown_removes_handlers(self):
+        self.plugin.shutdown()
+        self.bus.emit(Message("close"))
+        self.assertTrue(self.plugin.worker.online)
+
+
+class TestDebounceConfig(_PluginTest):
+    config = {"debounce_keys": {"30": 20, 31: 10}}
+
+    def setUp(self):
+        patcher = patch("ovos_phal_plugin_hotkeys.keyboard.set_debounce")
+        self.set_debounce = patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def test_scan_codes(self):
+        self.set_debounce.assert_called_once_with(0, {30: 0.02, 31: 0.01})
+
+
+class TestQueueOverflow(_PluginTest):
+    config = {"queue_overflow": "block"}
+
+    def test_invalid_policy(self):
+        with patch("ovos_phal_plugin_hotkeys.keyboard.subscribe") as subscribe:
+            subscribe.return_value.__enter__.return_value.get.side_effect = \
+                lambda timeout: setattr(self.plugin, "_running", False)
+            HotKeysPlugin.run(self.plugin)
+        subscribe.assert_called_once_with(maxsize=256, overflow_policy="drop_oldest")
+
+    def test_valid_policy(self):
+        self.plugin.config["queue_overflow"] = "drop_newest"
+        self.plugin.register_callbacks()
+        self.assertEqual(self.plugin._queue_overflow, "drop_newest")
+
+
+class TestDispatch(_PluginTest):
+    config = {"key_down": {"test.a": 30, "test.b": [30, 31], "test.combo": "ctrl+k"},
+              "key_up": {"test.c": [30, "ctrl+k"]}}
+
+    def setUp(self):
+        patcher = patch("ovos_phal_plugin_hotkeys.keyboard.add_hotkey")
+        self.add_hotkey = patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+        for msg_type in ("test.a", "test.b", "test.c", "test.combo"):
+            self.bus.on(msg_type, self.sent.append)
+
+    def trigger(self, event_type, key, count):
+        del self.sent[:]
+        self.plugin.handle_trigger(event_type, key)
+        self.wait_for(lambda: len(self.sent) == count)
+        return sorted(message.msg_type for message in self.sent)
+
+    def test_index(self):
+        self.assertEqual(self.plugin.dispatch_index, {
+            (KEY_DOWN, 30): ["test.a", "test.b"], (KEY_DOWN, 31): ["test.b"],
+            (KEY_DOWN, "ctrl+k"): ["test.combo"],
+            (KEY_UP, 30): ["test.c"], (KEY_UP, "ctrl+k"): ["test.c"]})
+
+    def test_fan_out(self):
+        self.assertEqual(self.trigger(KEY_DOWN, 30, 2), ["test.a", "test.b"])
+        self.assertEqual(self.trigger(KEY_DOWN, 31, 1), ["test.b"])
+        self.assertEqual(self.trigger(KEY_UP, 30, 1), ["test.c"])
+        self.assertEqual(self.trigger(KEY_UP, 31, 0), [])
+
+    def test_combos(self):
+        # only combos are registered with keyboard, scan codes are matched in run
+        # autorepeats are watched for the "pass" key_repeat policy
+        self.assertEqual(sorted(call.kwargs["args"] for call in self.add_hotkey.call_args_list),
+                         [(KEY_DOWN, "ctrl+k"), (KEY_HOLD, "ctrl+k"), (KEY_UP, "ctrl+k")])
+        self.assertEqual(self.trigger(KEY_DOWN, "ctrl+k", 1), ["test.combo"])
+        self.assertEqual(self.trigger(KEY_UP, "ctrl+k", 1), ["test.c"])
+        # the scan code of k alone is not the combo
+        self.assertEqual(self.trigger(KEY_DOWN, 37, 0), [])
+
+
+class TestMessages(_PluginTest):
+    config = {"messages": {"volume": {"type": "test.hotkey", "data": {"percent": 50},
+                                      "context": {"source": "hotkeys"}}}}
+
+    def test_static_data(self):
+        self.plugin.send("volume", {"count": 2}, {"hotkey": {"seq": 1}})
+        self.assertEqual(self.sent[0].data, {"percent": 50, "count": 2})
+        self.assertEqual(self.sent[0].context["source"], "hotkeys")
+        self.assertEqual(self.sent[0].context["hotkey"], {"seq": 1})
+        # the bus client adds the session to the context of every message
+        self.plugin.send("volume")
+        self.assertEqual(self.sent[1].data, {"percent": 50})
+        self.assertNotIn("hotkey", self.sent[1].context)
+        self.assertEqual(self.plugin.messages["volume"][2], {"source": "hotkeys"})
+
+    def test_plain_type(self):
+        self.plugin.send("test.hotkey")
+        self.assertEqual(self.sent[0].data, {})
+        self.assertEqual(self.plugin.messages.keys(), {"volume"})
+
+
+class TestEventContext(_PluginTest):
+    config = {"event_context": True,
+              "key_hold": {"test.hotkey": {"key": 30, "hold_ms": 10}},
+              "key_multi_tap": {"test.hotkey": {"key": 48, "taps": 2}}}
+
+    def press(self, event_type, scan_code, time_ns):
+        event = KeyboardEvent(event_type, scan_code, time_ns=time_ns, device="/dev/input/event0")
+        self.plugin.handle_trigger(event_type, scan_code, event)
+
+    def test_hold(self):
+        self.press(KEY_DOWN, 30, 1000)
+        self.wait_for(lambda: len(self.sent) == 1)
+        self.press(KEY_UP, 30, 2000)
+        self.assertEqual(self.sent[0].context["hotkey"]["time_ns"], 1000)
+        self.assertEqual(self.sent[0].context["hotkey"]["scan_code"], 30)
+
+    def test_multi_tap(self):
+        self.press(KEY_DOWN, 48, 1000)
+        self.press(KEY_UP, 48, 2000)
+        self.press(KEY_DOWN, 48, 3000)
+        self.wait_for(lambda: len(self.sent) == 1)
+        self.assertEqual(self.sent[0].context["hotkey"]["time_ns"], 3000)
+
+
+if __name__ == '__main__':
+    unittest.main()